@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Run many group search configs as one job
+Searches and group lookups shared between configs are only made once, using
+one datastore, HTTP session, cache and rate limit, and each config still
+gets its own filtered outputs
+"""
+import time
+import argparse
+import logging
+from collections import OrderedDict
+import query_meetup
+import datastore
+import group_search
+
+DATASTORE = 'batch'
+
+def config_handler():
+    '''
+    Manage batch configuration parsing
+    '''
+    parser = argparse.ArgumentParser(description='Query Meetup.com for many configs at once')
+    parser.add_argument('--configs',
+                        action="store",
+                        nargs='+',
+                        help='configuration files to run, the first supplies the meetup '
+                             'section used for every query',
+                        required=True)
+    parser.add_argument('--datastore',
+                        action="store",
+                        default=DATASTORE,
+                        help='base name of the datastore shared by every config')
+    parser.add_argument('--async',
+                        action="store_true",
+                        dest="async_mode",
+                        help='fetch group data concurrently')
+    parser.add_argument('--incremental',
+                        action="store_true",
+                        help='only refresh new or stale groups')
+    args = parser.parse_args()
+    configs = OrderedDict((path, group_search.load_config(path)) for path in args.configs)
+    if args.incremental:
+        for cfg in configs.values():
+            cfg['groups']['incremental'] = True
+    return args, configs
+
+def shared_config(configs):
+    '''
+    Config for the connection shared by every config
+    The meetup section comes from the first config, and the gazetteer is
+    indexed for the locations of every config, so no city misses it.
+    Geocoding only stays offline if every config asks for that
+    '''
+    first = next(iter(configs.values()))
+    groups = dict(first['groups'])
+    locations = OrderedDict()
+    for cfg in configs.values():
+        for country, cities in cfg['groups']['locations'].items():
+            merged = locations.setdefault(country, [])
+            merged.extend(city for city in cities if city not in merged)
+    groups['locations'] = locations
+    gazetteers = [cfg['groups']['gazetteer'] for cfg in configs.values()
+                  if cfg['groups'].get('gazetteer')]
+    if gazetteers:
+        groups['gazetteer'] = gazetteers[0]
+    groups['geocode_offline'] = all(cfg['groups'].get('geocode_offline',
+                                                      query_meetup.GEOCODE_OFFLINE)
+                                    for cfg in configs.values())
+    return dict(first, groups=groups)
+
+def shortest_refresh_age(configs):
+    '''
+    The shortest refresh_age of any incremental config, else None
+    '''
+    ages = [group_search.refresh_age(cfg) for cfg in configs.values()]
+    ages = [age for age in ages if age is not None]
+    return min(ages) if ages else None
+
+def plan_searches(configs):
+    '''
+    Merge the searches of every config, keeping each distinct one once
+    Returns a dict of (city, country, radius, search string) to the configs
+    that need it
+    '''
+    searches = OrderedDict()
+    for path, cfg in configs.items():
+        search_string = ' OR '.join(cfg['groups']['search_keys'])
+        for city, country in group_search.locations_handler(cfg).items():
+            key = (city, country, cfg['groups']['radius'], search_string)
+            searches.setdefault(key, []).append(path)
+    return searches
+
+def run_searches(meetup_conn, configs, searches):
+    '''
+    Run every distinct search, returning the ids each config found
+    '''
+    def search(key):
+        city, country, radius, search_string = key
+        cfg = configs[searches[key][0]]
+        print(f"Searching for groups in City: {city} Country: {country}")
+        try:
+            return list(meetup_conn.iter_search_for_groups(cfg['groups']['geonames_user'],
+                                                           city,
+                                                           country,
+                                                           radius,
+                                                           search_string))
+        except query_meetup.QueryError as error:
+            # Batch runs can't be resumed, so carry on with the other searches
+            print(f"Search failed for City: {city}, Country: {country}, "
+                  f"its groups are missing from {', '.join(searches[key])}: {error}")
+            return []
+
+    keys = list(searches)
+    if meetup_conn.async_mode:
+        results = meetup_conn.fetch_concurrent(search, keys)
+    else:
+        results = [search(key) for key in keys]
+    found = OrderedDict((path, []) for path in configs)
+    for key, ids in zip(keys, results):
+        for path in searches[key]:
+            found[path].extend(ids)
+    return found
+
+def main():
+    """
+    Main execution
+    """
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    started = time.time()
+    args, configs = config_handler()
+
+    # One connection, cache and rate limit shared by every config
+    first_path, first = next(iter(configs.items()))
+    meetup_conn = query_meetup.MSMeetup(first_path, cfg=shared_config(configs))
+    if args.async_mode:
+        meetup_conn.async_mode = True
+
+    store = None
+    # Pending datastore writes are committed, and the connection closed,
+    # even if the run fails part way
+    try:
+        backend = first['groups'].get('datastore_backend', datastore.BACKEND)
+        store = datastore.open_datastore(datastore.datastore_path(args.datastore, backend),
+                                         backend,
+                                         first['groups'].get('datastore_commit_every',
+                                                             datastore.COMMIT_EVERY))
+
+        # Cached responses mustn't outlive the data any config is refreshing
+        meetup_conn.cap_cache_ttls(shortest_refresh_age(configs))
+        searches = plan_searches(configs)
+        requested = sum(len(paths) for paths in searches.values())
+        print(f"Running {len(searches)} distinct searches for {requested} "
+              f"searches across {len(configs)} configs")
+        found = run_searches(meetup_conn, configs, searches)
+
+        # Each config checks its groups against its own refresh_age, and a group
+        # fetched for one config is fresh for the rest, so it's only looked up once
+        for path, cfg in configs.items():
+            group_search.check_groups_bulk(meetup_conn, cfg, found[path], store)
+        all_ids = list(dict.fromkeys(group_id for ids in found.values() for group_id in ids))
+        stored = store.get_many(all_ids)
+
+        # Event data fetched for one config is reused by the rest
+        for path, cfg in configs.items():
+            max_age = time.time() - started
+            if group_search.refresh_age(cfg) is not None:
+                max_age = max(max_age, group_search.refresh_age(cfg))
+            print(f"Filtering groups for {path}")
+            # Each config gets its own copies, as filters store results on groups
+            groups = [stored[group_id].copy() for group_id in dict.fromkeys(found[path])
+                      if group_id in stored]
+            groups = query_meetup.de_dupe(groups,
+                                          cfg['groups'].get('dedupe_key', query_meetup.DEDUPE_KEY))
+            filters = group_search.filter_handler(cfg)
+            pipeline = group_search.build_pipeline(cfg, filters)
+            columns = group_search.add_filter_columns(group_search.base_columns(), filters)
+            print(f"Creating output for {path}")
+            group_search.create_outputs(cfg,
+                                        columns,
+                                        pipeline.iter_run(meetup_conn, groups, store, max_age))
+            print(pipeline.report())
+    finally:
+        if store is not None:
+            store.close()
+        meetup_conn.close()
+
+if __name__ == "__main__":
+    main()
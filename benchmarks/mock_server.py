@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Meetup GraphQL API, serving synthetic groups and events
+Understands the queries MSMeetup sends: keyword search, single and aliased
+group queries, paged past events and Pro network listings. Latency and rate limiting are
+configurable so client behaviour can be measured against a known server.
+Run from the repository root: python benchmarks/mock_server.py --groups 10000
+"""
+
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+GROUPS = 10000
+CITIES = 10
+# Fraction of each city's groups also returned by the next city's search
+OVERLAP = 0.1
+MAX_EVENTS = 200
+EVENTS_PAGE = 20
+LATENCY = 0.0
+RATE = None
+PORT = 8765
+
+# Words used to make up group names, some matching the benchmark search keys
+NAME_WORDS = ['Python', 'Data', 'Cloud', 'DevOps', 'Cooking', 'Hiking', 'Rust',
+              'Books', 'Startup', 'Running', 'Security', 'Design']
+
+ALIAS = re.compile(r'(\w+): group\(id: \$(\w+)\)')
+
+class MockMeetup:
+    """
+    Deterministic synthetic Meetup data, generated on demand from group ids
+    City n is at latitude n+1, so a gazetteer can map city names to searches
+    Neither coordinate is ever 0, which get_lat_lon would treat as not found
+    """
+    def __init__(self,
+                 groups=GROUPS,
+                 cities=CITIES,
+                 overlap=OVERLAP,
+                 max_events=MAX_EVENTS,
+                 events_page=EVENTS_PAGE):
+        self.groups = groups
+        self.cities = cities
+        self.overlap = overlap
+        self.max_events = max_events
+        self.events_page = events_page
+        self.now = int(time.time())
+        self.network_events = None
+
+    def city_ids(self, city):
+        """
+        Group ids found by searching a city, overlapping the next city's
+        """
+        per_city = self.groups // self.cities
+        start = city * per_city
+        end = start + per_city + int(per_city * self.overlap)
+        return [str(group_id % self.groups) for group_id in range(start, end)]
+
+    def search(self, variables):
+        """
+        A page of keywordSearch results
+        """
+        ids = self.city_ids(int(round(float(variables['lat']))) - 1)
+        return page(ids, variables, lambda group_id: {'node': {'id': group_id}})
+
+    def event_times(self, group_id):
+        """
+        Past event times for a group, oldest first
+        """
+        rand = random.Random(group_id)
+        count = rand.randint(0, self.max_events)
+        gap = rand.randint(3, 60) * 86400
+        return [self.now - gap * (count - n) for n in range(count)]
+
+    def group(self, group_id, events=True, first=None, after=None):
+        """
+        Everything any group query might ask for, with one page of events
+        Events are only generated when the query asks for them
+        """
+        rand = random.Random(group_id)
+        words = rand.sample(NAME_WORDS, 2)
+        group = {'name': f"{words[0]} {words[1]} Group {group_id}",
+                 'link': f"https://www.meetup.com/mock-group-{group_id}/",
+                 'city': f"City{int(group_id) * self.cities // self.groups}",
+                 'country': 'gb',
+                 'memberships': {'count': rand.randint(0, 2000)}}
+        if not events:
+            return group
+        events = [{'node': {'id': f'{group_id}-{n}',
+                            'dateTime': time.strftime('%Y-%m-%dT%H:%M+00:00',
+                                                      time.gmtime(when))}}
+                  for n, when in enumerate(self.event_times(str(group_id)))]
+        past_events = page(events,
+                           {'first': first or self.events_page, 'after': after},
+                           lambda event: event)
+        past_events['count'] = len(events)
+        group['pastEvents'] = past_events
+        return group
+
+    def network(self, query, variables):
+        """
+        A page of a Pro network holding every group
+        Past events are built once, oldest group first, for paging through
+        """
+        if 'groupsSearch' in query:
+            def group_node(group_id):
+                group = self.group(str(group_id), False)
+                return {'node': {'id': str(group_id),
+                                 'name': group['name'],
+                                 'foundedDate': '2015-01-01T00:00:00.000Z',
+                                 'groupAnalytics': {'totalMembers':
+                                                    group['memberships']['count']}}}
+            connection = page(range(self.groups), variables, group_node)
+            return {'data': {'proNetworkByUrlname': {'groupsSearch': connection}}}
+        if variables.get('status') == 'PAST':
+            if self.network_events is None:
+                self.network_events = [(str(group_id), n, when)
+                                       for group_id in range(self.groups)
+                                       for n, when in enumerate(self.event_times(str(group_id)))]
+            events = self.network_events
+        else:
+            events = []
+        def event_node(event):
+            group_id, n, when = event
+            return {'node': {'id': f'{group_id}-{n}',
+                             'group': {'id': group_id},
+                             'dateTime': time.strftime('%Y-%m-%dT%H:%M+00:00',
+                                                       time.gmtime(when)),
+                             'going': random.Random(f'{group_id}-{n}').randint(0, 50)}}
+        connection = page(events, variables, event_node)
+        return {'data': {'proNetworkByUrlname': {'eventsSearch': connection}}}
+
+    def execute(self, query, variables):
+        """
+        Answer a GraphQL query
+        """
+        if 'proNetworkByUrlname' in query:
+            if 'Search' not in query:
+                return {'data': {'proNetworkByUrlname': {'id': 'mock',
+                                                         'name': 'Mock Network',
+                                                         'networkAnalytics':
+                                                         {'totalMembers': 0}}}}
+            return self.network(query, variables)
+        if 'keywordSearch' in query:
+            return {'data': {'keywordSearch': self.search(variables)}}
+        events = 'pastEvents' in query
+        aliases = ALIAS.findall(query)
+        if aliases:
+            return {'data': {alias: self.group(variables[name], events)
+                             for alias, name in aliases}}
+        if 'group(id: $groupid)' in query:
+            return {'data': {'group': self.group(variables['groupid'],
+                                                 events,
+                                                 variables.get('first'),
+                                                 variables.get('after'))}}
+        return {'errors': [{'message': 'Query not supported by the mock server'}]}
+
+def page(items, variables, edge):
+    """
+    Slice a connection by first/after, using the offset as the cursor
+    """
+    first = variables.get('first') or len(items)
+    start = int(variables.get('after') or 0)
+    end = start + first
+    return {'count': len(items),
+            'pageInfo': {'hasNextPage': end < len(items),
+                         'endCursor': str(end) if end < len(items) else None},
+            'edges': [edge(item) for item in items[start:end]]}
+
+class RateLimit:
+    """
+    Server side token bucket, requests beyond the rate get a 429
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Take a token if one is available
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+def make_handler(meetup, latency=LATENCY, rate=RATE):
+    """
+    Build a request handler class serving the given mock data
+    """
+    limiter = RateLimit(rate) if rate else None
+
+    class Handler(BaseHTTPRequestHandler):
+        """
+        Serve POSTed GraphQL queries
+        """
+        stats = {'requests': 0, 'limited': 0}
+
+        def do_POST(self): # pylint: disable=invalid-name
+            """
+            Answer a query, after the configured latency
+            """
+            Handler.stats['requests'] += 1
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if limiter and not limiter.allow():
+                Handler.stats['limited'] += 1
+                self.reply(429, {'errors': [{'message': 'Too many requests'}]},
+                           {'Retry-After': '1'})
+                return
+            if latency:
+                time.sleep(latency)
+            variables = body.get('variables') or {}
+            if isinstance(variables, str):
+                variables = json.loads(variables)
+            self.reply(200, meetup.execute(body['query'], variables))
+
+        def reply(self, status, payload, headers=None):
+            """
+            Send a JSON response
+            """
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            pass
+
+    return Handler
+
+class MockServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server with a listen backlog big enough for many clients
+    The default of 5 drops connections, stalling clients for a second
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+def start_server(meetup, port=0, latency=LATENCY, rate=RATE):
+    """
+    Start the mock server in a background thread, returning it and its URL
+    Port 0 picks any free port
+    """
+    server = MockServer(('127.0.0.1', port), make_handler(meetup, latency, rate))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/gql"
+
+def write_gazetteer(path, cities=CITIES):
+    """
+    Write a GeoNames style dump placing mock city n at latitude n+1
+    """
+    with open(path, 'w', encoding='utf-8') as dump:
+        for city in range(cities):
+            fields = [''] * 19
+            fields[1] = fields[2] = f"City{city}"
+            fields[4] = str(city + 1)
+            fields[5] = '1'
+            fields[8] = 'GB'
+            fields[14] = '1000'
+            dump.write('\t'.join(fields) + '\n')
+
+def main():
+    """
+    Run the mock server in the foreground
+    """
+    parser = argparse.ArgumentParser(description='Mock Meetup GraphQL server')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--groups', type=int, default=GROUPS,
+                        help='number of synthetic groups')
+    parser.add_argument('--cities', type=int, default=CITIES,
+                        help='number of cities the groups are spread over')
+    parser.add_argument('--events-page', type=int, default=EVENTS_PAGE,
+                        help='past events returned when a query does not page them')
+    parser.add_argument('--latency', type=float, default=LATENCY,
+                        help='seconds added to every response')
+    parser.add_argument('--rate', type=float, default=RATE,
+                        help='requests per second allowed before answering 429')
+    parser.add_argument('--gazetteer', help='also write a gazetteer for the mock cities here')
+    args = parser.parse_args()
+    if args.gazetteer:
+        write_gazetteer(args.gazetteer, args.cities)
+    meetup = MockMeetup(args.groups, args.cities, events_page=args.events_page)
+    server, url = start_server(meetup, args.port, args.latency, args.rate)
+    print(f"Serving {args.groups} mock groups at {url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Compare dateutil parse with the fromisoformat path on Meetup timestamps
+Run from the repository root: python benchmarks/parse_datetimes.py
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+from dateutil.parser import parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import query_meetup # pylint: disable=wrong-import-position
+
+COUNT = 100000
+OFFSETS = ['+00:00', '+01:00', '+02:00', '-05:00', '+05:30']
+
+def make_timestamps(count):
+    """
+    Generate dateTime strings in the format Meetup returns
+    """
+    rand = random.Random(0)
+    return [f"20{rand.randint(10, 24):02}-{rand.randint(1, 12):02}-{rand.randint(1, 28):02}"
+            f"T{rand.randint(0, 23):02}:{rand.choice(['00', '15', '30', '45'])}"
+            f"{rand.choice(OFFSETS)}"
+            for _ in range(count)]
+
+def time_parser(name, func, timestamps):
+    """
+    Time a parser over all timestamps and print its throughput
+    """
+    start = time.perf_counter()
+    parsed = [func(timestamp) for timestamp in timestamps]
+    elapsed = time.perf_counter() - start
+    print(f"{name:<16} {elapsed:8.3f}s {len(timestamps) / elapsed:12,.0f} per second")
+    return parsed, elapsed
+
+def main():
+    """
+    Run the benchmark
+    """
+    parser = argparse.ArgumentParser(description='Benchmark event dateTime parsing')
+    parser.add_argument('--count', type=int, default=COUNT,
+                        help='number of timestamps to parse')
+    args = parser.parse_args()
+    timestamps = make_timestamps(args.count)
+    slow, slow_time = time_parser('dateutil parse', parse, timestamps)
+    fast, fast_time = time_parser('parse_datetime', query_meetup.parse_datetime, timestamps)
+    if slow != fast:
+        raise SystemExit("Parsers disagree")
+    print(f"Speed up {slow_time / fast_time:.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""
+Benchmark group_search end to end and stage by stage against the mock server
+Each size runs search, check_groups, de-dup, every filter and export against
+a fresh datastore, then times the datastore backends on synthetic groups.
+Results can be saved as JSON and compared with an earlier run.
+Run from the repository root: python benchmarks/run_benchmarks.py --sizes 1000 10000
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+from collections import OrderedDict
+import yaml
+from prettytable import PrettyTable
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# pylint: disable=wrong-import-position
+import query_meetup
+import group_search
+import datastore
+import records
+import network_stats
+import mock_server
+
+SIZES = [1000, 10000, 100000]
+CITIES = 10
+# Large enough that profile queries never need a second page of events
+EVENTS_PAGE = mock_server.MAX_EVENTS
+LOOKUPS = 1000
+
+def write_config(path, url, gazetteer_path, workdir, cities=CITIES):
+    """
+    Write a config pointing MSMeetup at the mock server with every filter on
+    """
+    cfg = {'meetup': {'client_id': 'benchmark',
+                      'client_secret': 'benchmark',
+                      'base_api_url': url,
+                      'fetch_mode': 'async',
+                      'max_concurrency': 8,
+                      'pool_maxsize': 8,
+                      'batch_size': 50,
+                      'requests_per_second': 2000,
+                      'rate_burst': 100,
+                      'cache': False},
+           'groups': {'geonames_user': 'benchmark',
+                      'geocode_cache': False,
+                      'gazetteer': gazetteer_path,
+                      'geocode_offline': True,
+                      'radius': 10,
+                      'name_filter': True,
+                      'member_filter': True,
+                      'min_members': 100,
+                      'event_filter': True,
+                      'min_events': 5,
+                      'freq_filter': True,
+                      'min_freq': 30,
+                      'period_filter': True,
+                      'period': 6,
+                      'period_min': 1,
+                      'search_keys': ['Python', 'Data', 'Cloud'],
+                      'locations': {'GB': [f"City{city}" for city in range(cities)]},
+                      'output': {'types': ['csv', 'jsonl'],
+                                 'name': os.path.join(workdir, 'benchmark')}}}
+    with open(path, 'w', encoding='utf-8') as config:
+        yaml.safe_dump(cfg, config)
+    return cfg
+
+class Timer:
+    """
+    Collect stage timings in order
+    """
+    def __init__(self):
+        self.results = OrderedDict()
+
+    def time(self, stage, func, *args):
+        """
+        Run func, recording how long it took
+        """
+        start = time.perf_counter()
+        result = func(*args)
+        self.results[stage] = {'seconds': time.perf_counter() - start}
+        return result
+
+    def count(self, stage, items):
+        """
+        Record how many items a stage handled
+        """
+        self.results[stage]['items'] = items
+
+def bench_pipeline(config_path, cfg):
+    """
+    Run each stage of group_search in turn, timing them separately
+    """
+    timer = Timer()
+    group_search.set_datastore_paths(cfg, config_path)
+    meetup = query_meetup.MSMeetup(config_path, cfg=cfg)
+    store = group_search.open_datastore(cfg)
+    group_search.start_run(store, False)
+    res = timer.time('search', group_search.search_for_groups, meetup, cfg, store)
+    timer.count('search', len(res))
+    groups = timer.time('check_groups', group_search.check_groups, meetup, cfg, res, store)
+    timer.count('check_groups', len(groups))
+    groups = timer.time('de_dupe', query_meetup.de_dupe, groups)
+    timer.count('de_dupe', len(groups))
+    pipeline = group_search.build_pipeline(cfg, group_search.filter_handler(cfg))
+    total = len(groups)
+    groups = timer.time('filters', pipeline.run, meetup, groups)
+    timer.count('filters', total)
+    timer.results['filters: loading event data'] = {'seconds': pipeline.load_seconds}
+    for group_filter in pipeline.filters:
+        stats = pipeline.stats[group_filter.name]
+        timer.results[f'filters: {group_filter.name}'] = {'seconds': stats['seconds'],
+                                                          'items': stats['checked']}
+    columns = OrderedDict([('Name', 'name'), ('Members', 'members'), ('URL', 'link')])
+    timer.time('export', group_search.create_outputs, cfg, columns, groups)
+    timer.count('export', len(groups))
+    store.close()
+    timer.results['http requests'] = {'items': meetup.connection_stats()['requests']}
+    return timer.results
+
+def bench_network(config_path, cfg, workdir):
+    """
+    Time loading the whole mock network into columns, computing its
+    metrics and saving and reopening it
+    """
+    timer = Timer()
+    meetup = query_meetup.MSMeetup(config_path, cfg=cfg)
+    network = network_stats.NetworkStats()
+    timer.time('network: load', network.load, meetup, 'mock')
+    timer.count('network: load', len(network.event_index))
+    timer.time('network: metrics', network.metrics)
+    timer.count('network: metrics', len(network.names))
+    path = os.path.join(workdir, 'network.npz')
+    timer.time('network: save', network.save, path)
+    timer.time('network: open', network_stats.NetworkStats.open, path)
+    timer.count('network: open', len(network.event_index))
+    return timer.results
+
+def bench_end_to_end(config_path):
+    """
+    Time a complete group_search.py run in a fresh process
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(ROOT, 'group_search.py'),
+                    '--config', config_path],
+                   check=True,
+                   stdout=subprocess.DEVNULL,
+                   cwd=ROOT)
+    return {'end to end': {'seconds': time.perf_counter() - start}}
+
+def synthetic_groups(size):
+    """
+    Groups shaped like those fetched from the API
+    """
+    return [records.Group(str(group_id),
+                          name=f"Synthetic Group {group_id}",
+                          link=f"https://www.meetup.com/synthetic-{group_id}/",
+                          city='London',
+                          country='gb',
+                          members=group_id % 2000,
+                          fetched=time.time())
+            for group_id in range(size)]
+
+def bench_datastore(workdir, size):
+    """
+    Time the main datastore operations for each backend
+    """
+    timer = Timer()
+    groups = synthetic_groups(size)
+    ids = [group['id'] for group in groups]
+    lookups = random.Random(0).sample(ids, min(LOOKUPS, size))
+    for backend in datastore.BACKENDS:
+        path = datastore.datastore_path(os.path.join(workdir, 'bench'), backend)
+        store = datastore.open_datastore(path, backend)
+        timer.time(f'{backend}: upsert_many', store.upsert_many, groups)
+        timer.count(f'{backend}: upsert_many', size)
+        timer.time(f'{backend}: get_many', store.get_many, ids)
+        timer.count(f'{backend}: get_many', size)
+        timer.time(f'{backend}: all', lambda: list(store.all())) # pylint: disable=cell-var-from-loop
+        timer.count(f'{backend}: all', size)
+        timer.time(f'{backend}: get', lambda: [store.get(group_id) # pylint: disable=cell-var-from-loop
+                                               for group_id in lookups])
+        timer.count(f'{backend}: get', len(lookups))
+        store.close()
+    return timer.results
+
+def run_size(size, latency, rate, end_to_end, network=False):
+    """
+    Run every benchmark for one number of groups
+    """
+    results = OrderedDict()
+    meetup = mock_server.MockMeetup(size, CITIES, events_page=EVENTS_PAGE)
+    server, url = mock_server.start_server(meetup, latency=latency, rate=rate)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            gazetteer_path = os.path.join(workdir, 'cities.txt')
+            mock_server.write_gazetteer(gazetteer_path, CITIES)
+            config_path = os.path.join(workdir, 'benchmark.yml')
+            cfg = write_config(config_path, url, gazetteer_path, workdir)
+            results.update(bench_pipeline(config_path, cfg))
+            if end_to_end:
+                for backend in datastore.BACKENDS:
+                    path = datastore.datastore_path(config_path, backend)
+                    if os.path.isfile(path):
+                        os.remove(path)
+                results.update(bench_end_to_end(config_path))
+            results.update(bench_datastore(workdir, size))
+            if network:
+                results.update(bench_network(config_path, cfg, workdir))
+    finally:
+        server.shutdown()
+    return results
+
+def report(all_results, baseline=None):
+    """
+    Print a table per size, with the change from a baseline run if given
+    """
+    for size, results in all_results.items():
+        table = PrettyTable(['Stage', 'Seconds', 'Items', 'Items/s', 'vs baseline'])
+        table.align['Stage'] = 'l'
+        previous = (baseline or {}).get(size, {})
+        for stage, result in results.items():
+            seconds = result.get('seconds')
+            items = result.get('items', '')
+            rate = f"{items / seconds:,.0f}" if seconds and items else ''
+            change = ''
+            if seconds and previous.get(stage, {}).get('seconds'):
+                change = f"{(seconds / previous[stage]['seconds'] - 1) * 100:+.0f}%"
+            table.add_row([stage,
+                           '' if seconds is None else f"{seconds:.3f}",
+                           items,
+                           rate,
+                           change])
+        print(f"{size} groups")
+        print(table)
+
+def main():
+    """
+    Run the benchmark suite
+    """
+    parser = argparse.ArgumentParser(description='Benchmark group_search against a mock API')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='numbers of synthetic groups to benchmark with')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the mock server adds to every response')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='requests per second the mock server allows before a 429')
+    parser.add_argument('--no-end-to-end', action='store_true',
+                        help='skip the full group_search.py run')
+    parser.add_argument('--network', action='store_true',
+                        help='also benchmark network analytics over every mock event')
+    parser.add_argument('--json', help='save results to this file')
+    parser.add_argument('--baseline', help='compare with results saved by an earlier run')
+    args = parser.parse_args()
+    all_results = OrderedDict()
+    for size in args.sizes:
+        print(f"Benchmarking {size} groups")
+        all_results[str(size)] = run_size(size, args.latency, args.rate,
+                                          not args.no_end_to_end, args.network)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as previous:
+            baseline = json.load(previous)
+    report(all_results, baseline)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump(all_results, output, indent=2)
+
+if __name__ == '__main__':
+    main()
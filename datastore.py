@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+"""
+Datastore backends for group data fetched from meetup.com
+"""
+
+import os
+import json
+import pickle
+import sqlite3
+import time
+import records
+
+BACKEND = 'sqlite'
+COMMIT_EVERY = 50
+# SQLite limits the number of bound parameters in a single statement
+QUERY_CHUNK = 500
+
+class SQLiteDatastore:
+    """
+    Group datastore keyed by group id, backed by an indexed SQLite table
+    """
+    def __init__(self, path, commit_every=COMMIT_EVERY):
+        self.path = path
+        self.commit_every = commit_every
+        self.pending = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS groups (
+                                 id TEXT PRIMARY KEY,
+                                 data TEXT NOT NULL)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS profiles (
+                                 id TEXT PRIMARY KEY,
+                                 data TEXT NOT NULL,
+                                 checked REAL NOT NULL)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS last_run (
+                                 id TEXT PRIMARY KEY,
+                                 data TEXT NOT NULL)""")
+        # This run's groups, written as they are output and swapped into
+        # last_run once the run finishes
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS next_run (
+                                 id TEXT PRIMARY KEY,
+                                 data TEXT NOT NULL)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS checkpoints (
+                                 stage TEXT PRIMARY KEY,
+                                 data TEXT NOT NULL)""")
+        self.conn.commit()
+
+    def __contains__(self, group_id):
+        row = self.conn.execute("SELECT 1 FROM groups WHERE id = ?",
+                                (group_id,)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM groups").fetchone()[0]
+
+    def get(self, group_id):
+        """
+        Return a single group, or None if it isn't stored
+        """
+        row = self.conn.execute("SELECT data FROM groups WHERE id = ?",
+                                (group_id,)).fetchone()
+        if row is None:
+            return None
+        return records.Group.from_dict(json.loads(row[0]))
+
+    def get_many(self, group_ids):
+        """
+        Return a dict of group id to group for every stored id in group_ids
+        """
+        group_ids = list(group_ids)
+        groups = {}
+        for start in range(0, len(group_ids), QUERY_CHUNK):
+            chunk = group_ids[start:start + QUERY_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT id, data FROM groups WHERE id IN ({placeholders})", chunk)
+            for group_id, data in rows:
+                groups[group_id] = records.Group.from_dict(json.loads(data))
+        return groups
+
+    def all(self):
+        """
+        Yield every stored group
+        """
+        for (data,) in self.conn.execute("SELECT data FROM groups"):
+            yield records.Group.from_dict(json.loads(data))
+
+    def upsert(self, group):
+        """
+        Insert or replace a group, committing once enough writes are pending
+        """
+        self.conn.execute("INSERT OR REPLACE INTO groups (id, data) VALUES (?, ?)",
+                          (group['id'], encode(group)))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def upsert_many(self, groups):
+        """
+        Insert or replace many groups in a single transaction
+        """
+        self.conn.executemany("INSERT OR REPLACE INTO groups (id, data) VALUES (?, ?)",
+                              ((group['id'], encode(group)) for group in groups))
+        self.commit()
+
+    def get_profiles(self, group_ids):
+        """
+        Return a dict of group id to (event profile, time checked)
+        """
+        group_ids = list(group_ids)
+        profiles = {}
+        for start in range(0, len(group_ids), QUERY_CHUNK):
+            chunk = group_ids[start:start + QUERY_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT id, data, checked FROM profiles WHERE id IN ({placeholders})", chunk)
+            for group_id, data, checked in rows:
+                profiles[group_id] = (json.loads(data), checked)
+        return profiles
+
+    def put_profiles(self, profiles):
+        """
+        Store event profiles keyed by group id, stamped with the current time
+        """
+        now = time.time()
+        self.conn.executemany("INSERT OR REPLACE INTO profiles (id, data, checked) "
+                              "VALUES (?, ?, ?)",
+                              ((group_id, json.dumps(profile), now)
+                               for group_id, profile in profiles.items()))
+        self.commit()
+
+    def get_last_run(self):
+        """
+        Return the groups output by the previous run, keyed by id
+        """
+        return {group_id: records.Group.from_dict(json.loads(data)) for group_id, data
+                in self.conn.execute("SELECT id, data FROM last_run")}
+
+    def save_run(self, groups):
+        """
+        Replace the stored previous run with this run's groups
+        """
+        self.begin_run()
+        self.conn.executemany("INSERT OR REPLACE INTO next_run (id, data) VALUES (?, ?)",
+                              ((group['id'], encode(group)) for group in groups))
+        self.finish_run()
+
+    def begin_run(self):
+        """
+        Start collecting this run's groups, one at a time with add_to_run
+        """
+        self.conn.execute("DELETE FROM next_run")
+
+    def add_to_run(self, group):
+        """
+        Add a group to this run, without touching the previous run yet
+        """
+        self.conn.execute("INSERT OR REPLACE INTO next_run (id, data) VALUES (?, ?)",
+                          (group['id'], encode(group)))
+
+    def finish_run(self):
+        """
+        Replace the previous run with the groups added to this one
+        """
+        self.conn.execute("DELETE FROM last_run")
+        self.conn.execute("INSERT INTO last_run (id, data) SELECT id, data FROM next_run")
+        self.conn.execute("DELETE FROM next_run")
+        self.commit()
+
+    def get_checkpoint(self, stage):
+        """
+        Return the saved progress for a pipeline stage, or None
+        """
+        row = self.conn.execute("SELECT data FROM checkpoints WHERE stage = ?",
+                                (stage,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save_checkpoint(self, stage, data):
+        """
+        Save the progress of a pipeline stage, committing straight away
+        """
+        self.conn.execute("INSERT OR REPLACE INTO checkpoints (stage, data) VALUES (?, ?)",
+                          (stage, json.dumps(data)))
+        self.commit()
+
+    def clear_checkpoints(self):
+        """
+        Forget all saved progress
+        """
+        self.conn.execute("DELETE FROM checkpoints")
+        self.commit()
+
+    def commit(self):
+        """
+        Flush pending writes to disk
+        """
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        """
+        Commit and close the datastore
+        """
+        self.commit()
+        self.conn.close()
+
+class PickleDatastore:
+    """
+    Group datastore held in memory and written whole to a pickle file
+    """
+    def __init__(self, path, commit_every=COMMIT_EVERY):
+        self.path = path
+        self.commit_every = commit_every
+        self.pending = 0
+        self.groups = {}
+        self.profiles = {}
+        self.last_run = {}
+        self.next_run = {}
+        self.checkpoints = {}
+        if os.path.isfile(path):
+            print("Found datastore on disk")
+            state = load_state(path)
+            self.groups = {group['id']: records.Group.from_dict(group)
+                           for group in state['groups']}
+            self.profiles = state['profiles']
+            self.last_run = {group_id: records.Group.from_dict(group)
+                             for group_id, group in state['last_run'].items()}
+            self.checkpoints = state['checkpoints']
+
+    def __contains__(self, group_id):
+        return group_id in self.groups
+
+    def __len__(self):
+        return len(self.groups)
+
+    def get(self, group_id):
+        """
+        Return a single group, or None if it isn't stored
+        """
+        return self.groups.get(group_id)
+
+    def get_many(self, group_ids):
+        """
+        Return a dict of group id to group for every stored id in group_ids
+        """
+        return {group_id: self.groups[group_id]
+                for group_id in group_ids if group_id in self.groups}
+
+    def all(self):
+        """
+        Yield every stored group
+        """
+        yield from self.groups.values()
+
+    def upsert(self, group):
+        """
+        Insert or replace a group, writing once enough changes are pending
+        """
+        self.groups[group['id']] = group
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def upsert_many(self, groups):
+        """
+        Insert or replace many groups and write them out
+        """
+        for group in groups:
+            self.groups[group['id']] = group
+        self.commit()
+
+    def get_profiles(self, group_ids):
+        """
+        Return a dict of group id to (event profile, time checked)
+        """
+        return {group_id: self.profiles[group_id]
+                for group_id in group_ids if group_id in self.profiles}
+
+    def put_profiles(self, profiles):
+        """
+        Store event profiles keyed by group id, stamped with the current time
+        """
+        now = time.time()
+        for group_id, profile in profiles.items():
+            self.profiles[group_id] = (profile, now)
+        self.commit()
+
+    def get_last_run(self):
+        """
+        Return the groups output by the previous run, keyed by id
+        """
+        return dict(self.last_run)
+
+    def save_run(self, groups):
+        """
+        Replace the stored previous run with this run's groups
+        """
+        self.last_run = {group['id']: group for group in groups}
+        self.commit()
+
+    def begin_run(self):
+        """
+        Start collecting this run's groups, one at a time with add_to_run
+        """
+        self.next_run = {}
+
+    def add_to_run(self, group):
+        """
+        Add a group to this run, without touching the previous run yet
+        """
+        self.next_run[group['id']] = group
+
+    def finish_run(self):
+        """
+        Replace the previous run with the groups added to this one
+        """
+        self.last_run = self.next_run
+        self.next_run = {}
+        self.commit()
+
+    def get_checkpoint(self, stage):
+        """
+        Return the saved progress for a pipeline stage, or None
+        """
+        return self.checkpoints.get(stage)
+
+    def save_checkpoint(self, stage, data):
+        """
+        Save the progress of a pipeline stage, writing straight away
+        """
+        self.checkpoints[stage] = data
+        self.commit()
+
+    def clear_checkpoints(self):
+        """
+        Forget all saved progress
+        """
+        self.checkpoints = {}
+        self.commit()
+
+    def commit(self):
+        """
+        Write the whole datastore to disk
+        """
+        with open(self.path, "wb") as datastore:
+            pickle.dump({'groups': list(self.groups.values()),
+                         'profiles': self.profiles,
+                         'last_run': self.last_run,
+                         'checkpoints': self.checkpoints}, datastore)
+        self.pending = 0
+
+    def close(self):
+        """
+        Write and close the datastore
+        """
+        self.commit()
+
+def encode(group):
+    """
+    Serialise a group, record or plain dict, to JSON
+    """
+    return json.dumps(dict(group))
+
+BACKENDS = {'sqlite': (SQLiteDatastore, '.db'),
+            'pickle': (PickleDatastore, '.pkl')}
+
+def load_state(path):
+    """
+    Load a pickle datastore, older versions hold just a list of groups
+    """
+    with open(path, "rb") as datastore:
+        state = pickle.load(datastore)
+    if isinstance(state, list):
+        state = {'groups': state}
+    state.setdefault('profiles', {})
+    state.setdefault('last_run', {})
+    state.setdefault('checkpoints', {})
+    return state
+
+def datastore_path(config_path, backend=BACKEND):
+    """
+    Derive the datastore file name from the config file name
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown datastore backend "{backend}"')
+    return config_path + BACKENDS[backend][1]
+
+def migrate_pickle(store, pkl_path):
+    """
+    One time import of an old pickle datastore into another backend
+    The pickle is renamed afterwards so it is only migrated once
+    """
+    state = load_state(pkl_path)
+    groups = state['groups']
+    store.upsert_many(groups)
+    if state['profiles']:
+        store.put_profiles({group_id: profile
+                            for group_id, (profile, _) in state['profiles'].items()})
+    if state['last_run']:
+        store.save_run(state['last_run'].values())
+    os.rename(pkl_path, pkl_path + '.migrated')
+    print(f"Migrated {len(groups)} groups from {pkl_path}")
+
+def open_datastore(path, backend=BACKEND, commit_every=COMMIT_EVERY, pkl_path=None):
+    """
+    Open the configured datastore backend, migrating a pickle if one exists
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown datastore backend "{backend}"')
+    store = BACKENDS[backend][0](path, commit_every)
+    if backend != 'pickle' and pkl_path and os.path.isfile(pkl_path):
+        migrate_pickle(store, pkl_path)
+    return store
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Event statistics computed across many groups at once
+"""
+
+import time
+import numpy
+
+SECONDS_PER_DAY = 86400
+# Periods are configured in months, so use the average month length
+DAYS_PER_MONTH = 30.436875
+
+def to_epoch(datetimes):
+    """
+    Convert event datetimes to a sorted int64 array of epoch seconds
+    """
+    timestamps = numpy.fromiter((int(date_time.timestamp()) for date_time in datetimes),
+                                dtype=numpy.int64)
+    timestamps.sort()
+    return timestamps
+
+def from_list(timestamps):
+    """
+    Rebuild a timestamp array from the plain list kept in the datastore
+    """
+    timestamps = numpy.array(timestamps, dtype=numpy.int64)
+    timestamps.sort()
+    return timestamps
+
+def to_list(timestamps):
+    """
+    Convert a timestamp array to a plain list for the datastore
+    """
+    return timestamps.tolist()
+
+def to_values(array):
+    """
+    Convert a metric array to a list, with None where a group had no value
+    """
+    return [None if numpy.isnan(value) else value for value in array.tolist()]
+
+class EventStats:
+    """
+    Event timestamps for many groups packed end to end in one flat array
+    Group i's events are timestamps[offsets[i]:offsets[i+1]], each run sorted
+    Every metric is computed for all groups at once and returned as an array
+    """
+    def __init__(self, timestamp_arrays, now=None):
+        arrays = [numpy.empty(0, dtype=numpy.int64) if timestamps is None
+                  else numpy.asarray(timestamps, dtype=numpy.int64)
+                  for timestamps in timestamp_arrays]
+        self.counts = numpy.array([len(timestamps) for timestamps in arrays],
+                                  dtype=numpy.int64)
+        self.offsets = numpy.zeros(len(arrays) + 1, dtype=numpy.int64)
+        numpy.cumsum(self.counts, out=self.offsets[1:])
+        self.timestamps = numpy.concatenate(arrays) if arrays \
+            else numpy.empty(0, dtype=numpy.int64)
+        self.now = time.time() if now is None else now
+
+    @classmethod
+    def from_columns(cls, owners, timestamps, groups, now=None):
+        """
+        Build from parallel arrays of owning group index and timestamp, in
+        any order, for groups 0 to groups-1, without a per group array each
+        """
+        owners = numpy.asarray(owners, dtype=numpy.int64)
+        timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+        stats = cls([], now)
+        order = numpy.lexsort((timestamps, owners))
+        stats.timestamps = timestamps[order]
+        stats.counts = numpy.bincount(owners, minlength=groups).astype(numpy.int64)
+        stats.offsets = numpy.zeros(groups + 1, dtype=numpy.int64)
+        numpy.cumsum(stats.counts, out=stats.offsets[1:])
+        return stats
+
+    def __len__(self):
+        return len(self.counts)
+
+    def count_between(self, start, end):
+        """
+        Number of events per group after start and up to end
+        """
+        inside = (self.timestamps > start) & (self.timestamps <= end)
+        running = numpy.zeros(len(self.timestamps) + 1, dtype=numpy.int64)
+        numpy.cumsum(inside, out=running[1:])
+        return running[self.offsets[1:]] - running[self.offsets[:-1]]
+
+    def in_period(self, period):
+        """
+        Number of events per group in the past period months
+        """
+        start = self.now - period * DAYS_PER_MONTH * SECONDS_PER_DAY
+        return self.count_between(start, numpy.inf)
+
+    def trend(self, period):
+        """
+        Events in the past period months less those in the period before it
+        """
+        length = period * DAYS_PER_MONTH * SECONDS_PER_DAY
+        recent = self.count_between(self.now - length, numpy.inf)
+        previous = self.count_between(self.now - 2 * length, self.now - length)
+        return recent - previous
+
+    def frequency(self):
+        """
+        Average days between events per group, NaN with fewer than two events
+        The mean gap is just the span divided by the number of gaps
+        """
+        freq = numpy.full(len(self.counts), numpy.nan)
+        has_gaps = numpy.nonzero(self.counts > 1)[0]
+        first = self.timestamps[self.offsets[has_gaps]]
+        last = self.timestamps[self.offsets[has_gaps + 1] - 1]
+        mean_gap = (last - first) / (self.counts[has_gaps] - 1)
+        freq[has_gaps] = numpy.floor(mean_gap / SECONDS_PER_DAY)
+        return freq
+
+    def median_gap(self):
+        """
+        Median days between events per group, NaN with fewer than two events
+        """
+        median = numpy.full(len(self.counts), numpy.nan)
+        owner = numpy.repeat(numpy.arange(len(self.counts)), self.counts)
+        # Drop the gaps that span the boundary between two groups
+        same_group = owner[1:] == owner[:-1]
+        gaps = numpy.diff(self.timestamps)[same_group]
+        gap_owner = owner[1:][same_group]
+        gaps = gaps[numpy.lexsort((gaps, gap_owner))]
+        gap_counts = numpy.maximum(self.counts - 1, 0)
+        gap_offsets = numpy.cumsum(gap_counts) - gap_counts
+        has_gaps = numpy.nonzero(gap_counts)[0]
+        lower = gaps[gap_offsets[has_gaps] + (gap_counts[has_gaps] - 1) // 2]
+        upper = gaps[gap_offsets[has_gaps] + gap_counts[has_gaps] // 2]
+        median[has_gaps] = (lower + upper) / 2 / SECONDS_PER_DAY
+        return median
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Streaming exporters for group results
+"""
+
+import csv
+import json
+import query_meetup
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Rows buffered before a record batch is written to Parquet
+CHUNK_SIZE = 10000
+
+class TableExporter:
+    """
+    Print groups as a table on the console
+    """
+    def __init__(self, name, columns): # pylint: disable=unused-argument
+        self.columns = columns
+        self.table = query_meetup.create_table(columns, [])
+
+    def add(self, group):
+        """
+        Add a group as a row of the table
+        """
+        self.table.add_row([group[item] for item in self.columns.values()])
+
+    def close(self):
+        """
+        Print the table
+        """
+        print(self.table)
+
+class CSVExporter:
+    """
+    Write groups to a CSV file with the column headings as the header row
+    """
+    def __init__(self, name, columns):
+        if not name.endswith('.csv'):
+            name = name+".csv"
+        self.columns = columns
+        self.file = open(name, 'w', encoding='utf-8', newline='') # pylint: disable=consider-using-with
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns.keys())
+
+    def add(self, group):
+        """
+        Write a group as the next row
+        """
+        self.writer.writerow([group[item] for item in self.columns.values()])
+
+    def close(self):
+        """
+        Close the file
+        """
+        self.file.close()
+
+class JSONLinesExporter:
+    """
+    Write groups as newline delimited JSON, one object per group keyed by field
+    """
+    def __init__(self, name, columns):
+        if not name.endswith('.jsonl'):
+            name = name+".jsonl"
+        self.columns = columns
+        self.file = open(name, 'w', encoding='utf-8') # pylint: disable=consider-using-with
+
+    def add(self, group):
+        """
+        Write a group as the next line
+        """
+        row = {item: group[item] for item in self.columns.values()}
+        self.file.write(json.dumps(row) + '\n')
+
+    def close(self):
+        """
+        Close the file
+        """
+        self.file.close()
+
+class ParquetExporter:
+    """
+    Write groups to a Parquet file in record batches of CHUNK_SIZE rows
+    Columns are named by field, the schema is taken from the first batch
+    """
+    def __init__(self, name, columns):
+        if pyarrow is None:
+            raise SystemExit("Parquet output needs pyarrow, install it with pip install pyarrow")
+        if not name.endswith('.parquet'):
+            name = name+".parquet"
+        self.name = name
+        self.columns = columns
+        self.writer = None
+        self.rows = {item: [] for item in columns.values()}
+        self.count = 0
+
+    def add(self, group):
+        """
+        Buffer a group, writing a batch once the buffer is full
+        """
+        for item in self.columns.values():
+            self.rows[item].append(group[item])
+        self.count += 1
+        if self.count >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered groups as a record batch
+        """
+        if not self.count:
+            return
+        if self.writer is None:
+            table = pyarrow.table(self.rows)
+            self.writer = pyarrow.parquet.ParquetWriter(self.name, table.schema)
+        else:
+            table = pyarrow.table(self.rows, schema=self.writer.schema)
+        self.writer.write_table(table)
+        self.rows = {item: [] for item in self.columns.values()}
+        self.count = 0
+
+    def close(self):
+        """
+        Write any remaining groups and close the file
+        """
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+EXPORTERS = {'table': TableExporter,
+             'xlsx': query_meetup.SpreadsheetWriter,
+             'csv': CSVExporter,
+             'jsonl': JSONLinesExporter,
+             'parquet': ParquetExporter}
+
+def create_exporters(types, name, columns):
+    """
+    Create an exporter for each requested output type
+    """
+    exporters = []
+    for output in types:
+        if output not in EXPORTERS:
+            raise ValueError(f'Unknown output type "{output}"')
+        exporters.append(EXPORTERS[output](name, columns))
+    return exporters
+
+def export(exporters, groups):
+    """
+    Stream groups through every exporter, reading them only once
+    """
+    for group in groups:
+        for exporter in exporters:
+            exporter.add(group)
+    for exporter in exporters:
+        exporter.close()
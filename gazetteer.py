@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Offline city coordinates from a GeoNames cities dump
+"""
+
+import threading
+
+# Column positions in the tab separated GeoNames dump format
+NAME = 1
+ASCII_NAME = 2
+LATITUDE = 4
+LONGITUDE = 5
+COUNTRY_CODE = 8
+POPULATION = 14
+
+# Country codes used in configs that differ from ISO 3166
+COUNTRY_ALIASES = {'UK': 'GB'}
+
+def country_code(country):
+    """
+    Normalise a config country code to the one GeoNames uses
+    """
+    country = str(country).upper()
+    return COUNTRY_ALIASES.get(country, country)
+
+class Gazetteer:
+    """
+    City name to lat/lon index built from a GeoNames dump such as cities500.txt
+    The file is only read on first lookup, and only for the countries given
+    """
+    def __init__(self, path, countries=None):
+        self.path = path
+        self.countries = {country_code(country) for country in countries} if countries else None
+        self.index = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Build the index, keeping the most populous place for each name
+        """
+        index = {}
+        with open(self.path, 'r', encoding='utf-8') as dump:
+            for line in dump:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) <= POPULATION:
+                    continue
+                country = fields[COUNTRY_CODE]
+                if self.countries and country not in self.countries:
+                    continue
+                population = int(fields[POPULATION] or 0)
+                coords = (float(fields[LATITUDE]), float(fields[LONGITUDE]), population)
+                for name in {fields[NAME].lower(), fields[ASCII_NAME].lower()}:
+                    key = (name, country)
+                    if key not in index or index[key][2] < population:
+                        index[key] = coords
+        self.index = index
+        print(f"Loaded {len(index)} places from gazetteer {self.path}")
+
+    def lookup(self, city, country):
+        """
+        Return (lat, lon) for a city, or None if it isn't in the gazetteer
+        """
+        # Cities may be searched from several threads at once
+        with self.lock:
+            if self.index is None:
+                self.load()
+        coords = self.index.get((city.lower(), country_code(country)))
+        if coords is None:
+            return None
+        return coords[0], coords[1]
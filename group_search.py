@@ -7,10 +7,30 @@ import time
 import argparse
 import sys
 from collections import OrderedDict
-import pickle
 import logging
-import yaml
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import query_meetup
+import datastore
+import exporters
+import instrumentation
+
+# Hours before stored group and event data is refreshed in incremental mode
+REFRESH_AGE = 24
+
+def load_config(path):
+    '''
+    Load and check a config file
+    '''
+    if not os.path.isfile(path):
+        print(f"Could not find config file {path}")
+        sys.exit(1)
+
+    cfg = query_meetup.load_config(path)
+    if "groups" not in cfg:
+        print("Invalid configuration file")
+        sys.exit(1)
+    return cfg
 
 def config_handler():
     '''
@@ -22,30 +42,51 @@ def config_handler():
                         dest="config",
                         help='configuration file to use',
                         required=True)
+    parser.add_argument('--async',
+                        action="store_true",
+                        dest="async_mode",
+                        help='fetch group data concurrently')
+    parser.add_argument('--incremental',
+                        action="store_true",
+                        help='only refresh new or stale groups and report changes')
+    parser.add_argument('--resume',
+                        action="store_true",
+                        help='continue an interrupted run from its last checkpoint')
+    parser.add_argument('--record',
+                        action="store",
+                        metavar='DIR',
+                        help='record API responses to DIR for later replay')
+    parser.add_argument('--replay',
+                        action="store",
+                        metavar='DIR',
+                        help='replay API responses recorded in DIR instead of calling the API')
+    parser.add_argument('--report',
+                        action="store",
+                        metavar='FILE',
+                        help='write a JSON report of stage timings and API usage to FILE')
+    parser.add_argument('--profile',
+                        action="store",
+                        metavar='FILE',
+                        help='profile the run with cProfile, saving the stats to FILE')
+    parser.add_argument('--tracemalloc',
+                        action="store_true",
+                        help='trace memory allocations and report the peak and top sites')
     args = parser.parse_args()
 
-    if not os.path.isfile(args.config):
-        print(f"Could not find config file {args.config}")
-        sys.exit(1)
-
-    # Handle group specific config
-    with open(args.config, 'r', encoding='utf-8') as ymlfile:
-        try:
-            cfg = yaml.safe_load(ymlfile)
-        except yaml.YAMLError as exc:
-            print("Error parsing configuration file")
-            if hasattr(exc, 'problem_mark'):
-                mark = exc.problem_mark # pylint: disable=no-member
-                print(f"Config file does not seem to be correct YAML - \
-                        error at line {mark.line}, column {mark.column}")
-                sys.exit(1)
-    if "groups" not in cfg:
-        print("Invalid configuration file")
-        sys.exit(1)
-
-    cfg['groups']['datastore'] = args.config+'.pkl'
+    cfg = load_config(args.config)
+    set_datastore_paths(cfg, args.config)
+    if args.incremental:
+        cfg['groups']['incremental'] = True
     return args, cfg
 
+def set_datastore_paths(cfg, config_path):
+    '''
+    Keep the datastore, and any old pickle to migrate, next to the config
+    '''
+    backend = cfg['groups'].get('datastore_backend', datastore.BACKEND)
+    cfg['groups']['datastore'] = datastore.datastore_path(config_path, backend)
+    cfg['groups']['datastore_pkl'] = config_path+'.pkl'
+
 def filter_handler(cfg):
     '''
     Set up filters data structure from config
@@ -63,6 +104,52 @@ def filter_handler(cfg):
                                 cfg['groups']['period_min']]
     return filters
 
+def base_columns():
+    '''
+    Output columns every run has, as heading to group field
+    '''
+    return OrderedDict([('Name', 'name'),
+                        ('Members', 'members'),
+                        ('City', 'city'),
+                        ('Country', 'country'),
+                        ('URL', 'link')])
+
+def add_filter_columns(columns, filters):
+    '''
+    Add output columns for the results of the enabled event filters
+    '''
+    if filters['event_filter'][0]:
+        columns['Total Events'] = 'number_events'
+    if filters['period_filter'][0]:
+        columns['Events in Period'] = 'number_in_period'
+        columns['Period (months)'] = 'period'
+        columns['Trend'] = 'trend'
+    if filters['freq_filter'][0]:
+        columns['Frequency (days)'] = 'event_freq'
+        columns['Median Gap (days)'] = 'median_gap'
+    return columns
+
+def build_pipeline(cfg, filters):
+    '''
+    Set up the filter pipeline from the enabled filters
+    '''
+    stages = []
+    if filters['name_filter'][0]:
+        stages.append(query_meetup.NameFilter(cfg['groups']['search_keys'],
+                                              cfg['groups'].get('name_word_boundary',
+                                                                query_meetup.NAME_WORD_BOUNDARY),
+                                              cfg['groups'].get('name_exclude')))
+    if filters['member_filter'][0]:
+        stages.append(query_meetup.MemberFilter(filters['member_filter'][1]))
+    if filters['event_filter'][0]:
+        stages.append(query_meetup.EventFilter(filters['event_filter'][1]))
+    if filters['period_filter'][0]:
+        stages.append(query_meetup.PeriodFilter(filters['period_filter'][1],
+                                                filters['period_filter'][2]))
+    if filters['freq_filter'][0]:
+        stages.append(query_meetup.FreqFilter(filters['freq_filter'][1]))
+    return query_meetup.FilterPipeline(stages)
+
 def locations_handler(cfg):
     '''
     Handle locations
@@ -74,80 +161,301 @@ def locations_handler(cfg):
             locations[location] = country
     return locations
 
-def check_for_data(ds_file):
+def open_datastore(cfg):
     '''
-    Check for existing data
+    Open the datastore configured for this run
     '''
-    if os.path.isfile(ds_file):
-        print("Found datastore on disk")
-        with open(ds_file, "rb") as datastore:
-            groups = pickle.load(datastore)
-    else:
-        groups = []
-    return groups
+    return datastore.open_datastore(cfg['groups']['datastore'],
+                                    cfg['groups'].get('datastore_backend',
+                                                      datastore.BACKEND),
+                                    cfg['groups'].get('datastore_commit_every',
+                                                      datastore.COMMIT_EVERY),
+                                    cfg['groups']['datastore_pkl'])
+
+def create_outputs(cfg, columns, groups, extra=None):
+    '''
+    Create outputs, along with any extra exporters given
+    groups is read once, with each group passed to every output in turn, so
+    it can be a generator straight from the filter pipeline
+    '''
+    output_cfg = cfg['groups']['output']
+    name = output_cfg.get('name', output_cfg.get('sheet_name'))
+    outputs = exporters.create_exporters(output_cfg['types'], name, columns)
+    exporters.export(outputs + list(extra or []), groups)
 
-def create_outputs(cfg, columns, groups):
+def start_run(store, resume):
     '''
-    Create outputs
+    Pick up the checkpoints of an interrupted run, or start a fresh run
     '''
-    outputs = []
-    for output in cfg['groups']['output']['types']:
-        outputs.append(output)
-    if 'xlsx' in outputs:
-        sheet_name = cfg['groups']['output']['sheet_name']
-        query_meetup.create_spreadsheet(sheet_name, columns, groups)
-    if 'table' in outputs:
-        table = query_meetup.create_table(columns, groups)
-        print(table)
+    run = store.get_checkpoint('run') if resume else None
+    if run:
+        print("Resuming interrupted run")
+        return run
+    if resume:
+        print("No interrupted run found, starting from scratch")
+    store.clear_checkpoints()
+    run = {'started': time.time()}
+    store.save_checkpoint('run', run)
+    return run
 
-def search_for_groups(meetup_conn, cfg):
+def search_for_groups(meetup_conn, cfg, store):
     '''
     Search for groups
+    Cities whose search fails aren't checkpointed, and QueryError is raised
+    once the rest are done, so --resume searches just those again
     '''
+    if meetup_conn.async_mode:
+        return search_for_groups_parallel(meetup_conn, cfg, store)
     locations = locations_handler(cfg)
-    res = []
+    checkpoint = store.get_checkpoint('search') or {'cities': [], 'res': []}
+    res = checkpoint['res']
+    failed = []
+    # Neighbouring cities overlap, so drop ids already found as they stream in
+    deduper = query_meetup.DeDuper(lambda group_id: group_id)
+    deduper.seen.update(res)
     for city, country in locations.items():
+        if city in checkpoint['cities']:
+            print(f"Already searched City: {city} Country: {country}")
+            continue
         print(f"Searching for groups in City: {city} Country: {country}")
         search_string = ' OR '.join(cfg['groups']['search_keys'])
-        res += meetup_conn.search_for_groups(cfg['groups']['geonames_user'],
-                                             city,
-                                             country,
-                                             cfg['groups']['radius'],
-                                             search_string)
-        if not res:
-            print("No results for City: {city}, Country: {country}")
-        time.sleep(cfg['groups']['api_rate_limit'])
+        found = len(res)
+        try:
+            res.extend(deduper.filter(
+                meetup_conn.iter_search_for_groups(cfg['groups']['geonames_user'],
+                                                   city,
+                                                   country,
+                                                   cfg['groups']['radius'],
+                                                   search_string),
+                city))
+        except query_meetup.QueryError as error:
+            print(f"Search failed for City: {city}, Country: {country}: {error}")
+            failed.append(city)
+            continue
+        if len(res) == found and not deduper.duplicates.get(city):
+            print(f"No results for City: {city}, Country: {country}")
+        checkpoint['cities'].append(city)
+        store.save_checkpoint('search', checkpoint)
+    for city, count in deduper.duplicates.items():
+        print(f"City: {city} returned {count} groups already found")
+    search_failed(store, checkpoint, failed)
+    return res
+
+def search_failed(store, checkpoint, failed):
+    '''
+    Raise QueryError if any city's search failed, keeping what was found
+    '''
+    if not failed:
+        return
+    store.save_checkpoint('search', checkpoint)
+    raise query_meetup.QueryError(f"Search failed for {', '.join(failed)}, "
+                                  "run again with --resume to retry")
+
+def search_for_groups_parallel(meetup_conn, cfg, store):
+    '''
+    Search all cities at once, streaming ids into a de-duplicated list
+    Details for new groups are fetched while other cities are still searching
+    '''
+    locations = locations_handler(cfg)
+    checkpoint = store.get_checkpoint('search') or {'cities': [], 'res': []}
+    groups_checkpoint = store.get_checkpoint('groups') or {'checked': []}
+    res = checkpoint['res']
+    deduper = query_meetup.DeDuper(lambda group_id: group_id)
+    deduper.seen.update(res)
+    search_string = ' OR '.join(cfg['groups']['search_keys'])
+    # Search workers put (city, group id) here, and (city, None) when done
+    found_ids = queue.Queue()
+    errors = {}
+
+    def search_city(city, country):
+        try:
+            print(f"Searching for groups in City: {city} Country: {country}")
+            for group_id in meetup_conn.iter_search_for_groups(cfg['groups']['geonames_user'],
+                                                               city,
+                                                               country,
+                                                               cfg['groups']['radius'],
+                                                               search_string):
+                found_ids.put((city, group_id))
+        except query_meetup.QueryError as error:
+            errors[city] = error
+        finally:
+            found_ids.put((city, None))
+
+    pending = {city: country for city, country in locations.items()
+               if city not in checkpoint['cities']}
+    for city in locations:
+        if city not in pending:
+            print(f"Already searched City: {city} Country: {locations[city]}")
+    # Batched fetches are cheaper than prefetching one group at a time
+    prefetch = meetup_conn.batch_size <= 1
+    details = {}
+    with ThreadPoolExecutor(max_workers=meetup_conn.max_concurrency) as pool:
+        searches = [pool.submit(search_city, city, country)
+                    for city, country in pending.items()]
+        results = {city: 0 for city in pending}
+        remaining = len(searches)
+        # Only this thread touches the datastore
+        while remaining:
+            city, group_id = found_ids.get()
+            if group_id is None:
+                remaining -= 1
+                if city in errors:
+                    print(f"Search failed for City: {city}, Country: {pending[city]}: "
+                          f"{errors[city]}")
+                    continue
+                if not results[city] and not deduper.duplicates.get(city):
+                    print(f"No results for City: {city}, Country: {pending[city]}")
+                checkpoint['cities'].append(city)
+                store.save_checkpoint('search', checkpoint)
+                continue
+            if not list(deduper.filter([group_id], city)):
+                continue
+            results[city] += 1
+            res.append(group_id)
+            if prefetch and not is_fresh(cfg, store.get(group_id)):
+                details[group_id] = pool.submit(meetup_conn.get_group, group_id)
+        for search in searches:
+            search.result()
+        for group_id, detail in details.items():
+            group = detail.result()
+            groups_checkpoint['checked'].append(group_id)
+            # Groups that couldn't be fetched are left out
+            if group is None:
+                continue
+            group['fetched'] = time.time()
+            logging.debug(group)
+            store.upsert(group)
+    store.save_checkpoint('groups', groups_checkpoint)
+    for city, count in deduper.duplicates.items():
+        print(f"City: {city} returned {count} groups already found")
+    search_failed(store, checkpoint, list(errors))
     return res
 
+def refresh_age(cfg):
+    '''
+    Maximum age in seconds of stored data in incremental mode, else None
+    '''
+    if not cfg['groups'].get('incremental'):
+        return None
+    return cfg['groups'].get('refresh_age', REFRESH_AGE) * 3600
+
+def is_fresh(cfg, group):
+    '''
+    Check whether a stored group can be used without fetching it again
+    '''
+    max_age = refresh_age(cfg)
+    if group is None:
+        return False
+    return max_age is None or time.time() - group.get('fetched', 0) <= max_age
+
 def check_groups(meetup_conn,
                  cfg,
-                 filters,
-                 res):
+                 res,
+                 store):
     '''
     Check groups
     '''
-    groups = check_for_data(cfg['groups']['datastore'])
-    for group_id in res:
-        if groups and next((group for group in groups if group["id"] == group_id), None):
-            group_name = [group['name'] for group in groups if group['id'] == group_id][0]
-            print(f"Found {group_name} in datastore")
-        else:
+    # Ids already checked by an interrupted run
+    checkpoint = store.get_checkpoint('groups') or {'checked': []}
+    checked = set(checkpoint['checked'])
+    res = [group_id for group_id in res if group_id not in checked]
+    if meetup_conn.async_mode or meetup_conn.batch_size > 1:
+        check_groups_bulk(meetup_conn, cfg, res, store)
+        checkpoint['checked'].extend(res)
+    else:
+        for group_id in res:
+            if len(checkpoint['checked']) % store.commit_every == 0:
+                store.save_checkpoint('groups', checkpoint)
+            checkpoint['checked'].append(group_id)
+            group = store.get(group_id)
+            if is_fresh(cfg, group):
+                print(f"Found {group['name']} in datastore")
+                continue
             print(f"Checking group data for {group_id}")
             group = meetup_conn.get_group(group_id)
+            if group is None:
+                continue
+            group['fetched'] = time.time()
             logging.debug(group)
-            if filters['name_filter'][0]:
-                if query_meetup.check_name_filter(cfg['groups']['search_keys'], group):
-                    groups.append(group)
-                    with open(cfg['groups']['datastore'], "wb") as datastore:
-                        pickle.dump(groups, datastore)
-                    time.sleep(cfg['groups']['api_rate_limit'])
-                else:
-                    logging.debug("Group %s does not match name filter", group['name'])
-                    continue
+            store.upsert(group)
 
-    groups = [group for group in groups if group['id'] in res]
+    store.save_checkpoint('groups', checkpoint)
+    unique_ids = list(dict.fromkeys(checkpoint['checked']))
+    found = store.get_many(unique_ids)
+    groups = [found[group_id] for group_id in unique_ids if group_id in found]
     return groups
 
+def check_groups_bulk(meetup_conn,
+                      cfg,
+                      res,
+                      store):
+    '''
+    Check groups, fetching everything missing from the datastore in bulk
+    '''
+    unique_ids = list(dict.fromkeys(res))
+    known = store.get_many(unique_ids)
+    new_ids = [group_id for group_id in unique_ids
+               if not is_fresh(cfg, known.get(group_id))]
+    print(f"Found {len(unique_ids) - len(new_ids)} groups in datastore, "
+          f"fetching {len(new_ids)} in bulk")
+    fetched = query_meetup.fetch_for_groups(meetup_conn,
+                                            meetup_conn.get_group,
+                                            new_ids,
+                                            meetup_conn.get_groups)
+    # Groups that couldn't be fetched are left out
+    fetched = [group for group in fetched if group is not None]
+    for group in fetched:
+        group['fetched'] = time.time()
+        logging.debug(group)
+    store.upsert_many(fetched)
+
+class ChangeReporter:
+    '''
+    Output comparing each group with the previous run as it streams past,
+    then reporting what changed and saving this run in the datastore
+    Only the ids seen and names of added and changed groups are kept
+    '''
+    def __init__(self, store, cfg, columns):
+        self.store = store
+        self.incremental = cfg['groups'].get('incremental')
+        self.fields = list(columns.values())
+        self.previous = store.get_last_run() if self.incremental else {}
+        self.seen = set()
+        self.added = []
+        self.changed = []
+        store.begin_run()
+
+    def add(self, group):
+        '''
+        Compare a group with the previous run and add it to this one
+        '''
+        self.seen.add(group['id'])
+        self.store.add_to_run(group)
+        if not self.incremental:
+            return
+        before = self.previous.get(group['id'])
+        if before is None:
+            self.added.append(group['name'])
+        elif any(group.get(item) != before.get(item) for item in self.fields):
+            self.changed.append(group['name'])
+
+    def close(self):
+        '''
+        Report the changes and replace the stored previous run
+        '''
+        if self.incremental:
+            removed = [group['name'] for group_id, group in self.previous.items()
+                       if group_id not in self.seen]
+            print(f"Since the last run: {len(self.added)} groups added, "
+                  f"{len(removed)} removed, {len(self.changed)} changed")
+            for name in self.added:
+                print(f"Added: {name}")
+            for name in removed:
+                print(f"Removed: {name}")
+            for name in self.changed:
+                print(f"Changed: {name}")
+        self.store.finish_run()
+
 def main():
     """
     Main execution
@@ -155,62 +463,80 @@ def main():
 
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-    columns = OrderedDict([('Name', 'name'),
-                           ('Members', 'members'),
-                           ('City', 'city'),
-                           ('Country', 'country'),
-                           ('URL', 'link')])
+    columns = base_columns()
 
     args, cfg = config_handler()
+    profiler = instrumentation.Profiler(args.profile, args.tracemalloc)
+    profiler.start()
+    run_report = instrumentation.RunReport()
 
-    meetup_conn = query_meetup.MSMeetup(args.config)
+    meetup_conn = None
+    store = None
+    # Pending datastore writes are committed, and the connection closed,
+    # even if the run fails part way
+    try:
+        with run_report.stage('setup'):
+            meetup_conn = query_meetup.MSMeetup(args.config, args.record, args.replay, cfg)
+            if args.async_mode:
+                meetup_conn.async_mode = True
+            # Cached responses mustn't outlive the data they are refreshing
+            meetup_conn.cap_cache_ttls(refresh_age(cfg))
 
-    # Set up filters data structure from config
-    filters = filter_handler(cfg)
+            # Set up filters data structure from config
+            filters = filter_handler(cfg)
 
-    rate_limit = cfg['groups']['api_rate_limit']
+            store = open_datastore(cfg)
+            run = start_run(store, args.resume)
 
-    # Search for groups
-    res = search_for_groups(meetup_conn, cfg)
+        # Search for groups
+        with run_report.stage('search'):
+            res = search_for_groups(meetup_conn, cfg, store)
+        run_report.count('found', len(res))
 
-    groups = check_groups(meetup_conn, cfg, filters, res)
+        max_age = refresh_age(cfg)
+        if args.resume:
+            # Event data fetched earlier in the interrupted run is still good
+            max_age = max(max_age or 0, time.time() - run['started'])
+        # Stored event data is only reused when running incrementally or
+        # resuming, but event data is always checkpointed to the store
 
-    print ("Deduplicating results")
-    groups = query_meetup.de_dupe(groups)
-    logging.debug(query_meetup.create_table(columns, groups))
+        with run_report.stage('check_groups'):
+            groups = check_groups(meetup_conn, cfg, res, store)
+        run_report.count('checked', len(groups))
 
-    if filters['member_filter'][0]:
-        print ("Applying member filter")
-        groups = query_meetup.filter_on_members(filters, groups)
-        logging.debug(query_meetup.create_table(columns, groups))
-    if filters['event_filter'][0]:
-        print ("Applying event filter")
-        groups = query_meetup.filter_on_events(meetup_conn,
-                                               filters,
-                                               groups,
-                                               rate_limit)
-        columns['Total Events'] = 'number_events'
-        logging.debug(query_meetup.create_table(columns, groups))
-    if filters['period_filter'][0]:
-        print ("Applying period filter")
-        groups = query_meetup.filter_on_period(meetup_conn,
-                                               filters,
-                                               groups,
-                                               rate_limit)
-        columns['Events in Period'] = 'number_in_period'
-        columns['Period (months)'] = 'period'
-        logging.debug(query_meetup.create_table(columns, groups))
-    if filters['freq_filter'][0]:
-        print ("Applying frequency filter")
-        groups = query_meetup.filter_on_freq(meetup_conn,
-                                             filters,
-                                             groups,
-                                             rate_limit)
-        columns['Frequency (days)'] = 'event_freq'
-        logging.debug(query_meetup.create_table(columns, groups))
+        print ("Deduplicating results")
+        with run_report.stage('de_dupe'):
+            groups = query_meetup.de_dupe(groups,
+                                          cfg['groups'].get('dedupe_key', query_meetup.DEDUPE_KEY))
+        run_report.count('unique', len(groups))
+        logging.debug(query_meetup.LazyTable(columns, groups))
+
+        # Cheap local filters run first, so event data is only fetched for
+        # groups that pass them. Groups stream from the filters straight into
+        # the outputs and change report, so the results are never held as a list
+        print ("Applying filters and creating output")
+        pipeline = build_pipeline(cfg, filters)
+        add_filter_columns(columns, filters)
+        changes = ChangeReporter(store, cfg, columns)
+        with run_report.stage('filters_and_output'):
+            create_outputs(cfg,
+                           columns,
+                           pipeline.iter_run(meetup_conn, groups, store, max_age),
+                           [changes])
+        run_report.count('filtered', len(changes.seen))
+        print(pipeline.report())
+        store.clear_checkpoints()
 
-    print ("Creating output")
-    create_outputs(cfg, columns, groups)
+        profiler.stop()
+        print("Stage times: " + ' '.join(f"{stage} {seconds:.1f}s"
+                                         for stage, seconds in run_report.stages.items()))
+        if args.report:
+            run_report.write(args.report, meetup_conn, pipeline, profiler)
+    finally:
+        if store is not None:
+            store.close()
+        if meetup_conn is not None:
+            meetup_conn.close()
 
 if __name__ == "__main__":
     main()
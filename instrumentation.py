@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Run timing, API accounting and optional profiling for group searches
+"""
+
+import io
+import json
+import time
+import pstats
+import cProfile
+import tracemalloc
+import contextlib
+from collections import OrderedDict
+
+# Number of functions and allocation sites listed by the profilers
+PROFILE_TOP = 25
+MEMORY_TOP = 10
+
+class RunReport:
+    """
+    Collect wall time per stage and item counts, and build a structured
+    report of a run from them and the statistics MSMeetup keeps
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.counts = OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the body of a with block as a named stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = round(time.perf_counter() - start, 3)
+
+    def count(self, name, value):
+        """
+        Record a count, such as the number of groups after a stage
+        """
+        self.counts[name] = value
+
+    def build(self, meetup, pipeline=None, profiler=None):
+        """
+        Assemble the report as a dict ready for JSON
+        """
+        report = OrderedDict()
+        report['started'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started))
+        report['seconds'] = round(time.time() - self.started, 3)
+        report['stages'] = self.stages
+        report['counts'] = self.counts
+        report['api'] = {kind: dict(stats, seconds=round(stats['seconds'], 3))
+                         for kind, stats in meetup.api_stats.items()}
+        limiter = meetup.rate_limiter
+        report['rate_limiter'] = {'requests': limiter.stats['requests'],
+                                  'backoffs': limiter.stats['backoffs'],
+                                  'sleep_seconds': round(limiter.stats['throttled'], 3),
+                                  'working_seconds': round(limiter.stats['working'], 3),
+                                  'rate': round(limiter.rate, 3)}
+        report['connections'] = meetup.connection_stats()
+        if meetup.cache:
+            report['cache'] = dict(meetup.cache.stats, evicted=meetup.cache.evicted)
+        if meetup.geocache:
+            report['geocode_cache'] = {'hits': meetup.geocache.hits,
+                                       'misses': meetup.geocache.misses}
+        if meetup.replayer:
+            report['replayed'] = meetup.replayer.replayed
+        if pipeline:
+            report['filters'] = OrderedDict(
+                (group_filter.name,
+                 dict(pipeline.stats[group_filter.name],
+                      seconds=round(pipeline.stats[group_filter.name]['seconds'], 3),
+                      cost=group_filter.cost))
+                for group_filter in pipeline.filters)
+            report['filters_load_seconds'] = round(pipeline.load_seconds, 3)
+        if profiler and profiler.memory:
+            report['memory'] = profiler.memory
+        return report
+
+    def write(self, path, meetup, pipeline=None, profiler=None):
+        """
+        Write the report as JSON
+        """
+        with open(path, 'w', encoding='utf-8') as output:
+            json.dump(self.build(meetup, pipeline, profiler), output, indent=2)
+        print(f"Run report written to {path}")
+
+class Profiler:
+    """
+    Optional cProfile and tracemalloc hooks around a run
+    """
+    def __init__(self, profile_path=None, trace_memory=False):
+        self.profile_path = profile_path
+        self.trace_memory = trace_memory
+        self.profile = None
+        self.memory = None
+
+    def start(self):
+        """
+        Start whichever profilers were asked for
+        """
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.profile_path:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        """
+        Stop profiling, saving and printing what was found
+        """
+        if self.profile:
+            self.profile.disable()
+        # Snapshot memory before the profile stats add allocations of their own
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:MEMORY_TOP]
+            tracemalloc.stop()
+            self.memory = {'current_bytes': current,
+                           'peak_bytes': peak,
+                           'top': [{'where': str(stat.traceback), 'bytes': stat.size}
+                                   for stat in top]}
+            print(f"Memory: current {current / 2**20:.1f} MiB peak {peak / 2**20:.1f} MiB")
+            for stat in top:
+                print(stat)
+        if self.profile:
+            self.profile.dump_stats(self.profile_path)
+            summary = io.StringIO()
+            pstats.Stats(self.profile, stream=summary).sort_stats('cumulative') \
+                .print_stats(PROFILE_TOP)
+            print(summary.getvalue())
+            print(f"Profile written to {self.profile_path}")
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+"""
+Analytics across every group and event in a Meetup Pro network
+Groups and events are streamed from the API a page at a time into growable
+NumPy columns, keeping only the fields the metrics need, so large networks
+never sit in memory as JSON. Per group totals are updated as each event
+arrives, and everything is saved to a compressed .npz file so later runs
+update the stored network rather than starting again.
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+from collections import OrderedDict
+import numpy
+from prettytable import PrettyTable
+import query_meetup
+import event_stats
+import exporters
+
+# Only the fields the metrics need are requested
+GROUP_STATS_FIELDS = """
+                            id
+                            name
+                            foundedDate
+                            groupAnalytics {
+                                totalMembers
+                                }"""
+EVENT_STATS_FIELDS = """
+                            id
+                            group {
+                                id
+                            }
+                            dateTime
+                            going"""
+
+STATUSES = ['PAST', 'UPCOMING']
+# Months of recent activity, and days of membership growth, to report on
+PERIOD = 6
+GROWTH_DAYS = 30
+INITIAL_CAPACITY = 1024
+STORE = 'network'
+# Stands in for an unknown founding or event time
+MISSING = -1
+
+class Column:
+    """
+    A NumPy array that grows as values are appended, doubling in capacity
+    so appends are amortised constant time
+    """
+    def __init__(self, dtype, fill=0, values=None):
+        self.fill = fill
+        if values is None:
+            values = numpy.empty(0, dtype=dtype)
+        self.size = len(values)
+        self.array = numpy.full(max(INITIAL_CAPACITY, self.size), fill, dtype=dtype)
+        self.array[:self.size] = values
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, row):
+        return self.array[row]
+
+    def __setitem__(self, row, value):
+        self.array[row] = value
+
+    def append(self, value):
+        """
+        Add a value, returning its row
+        """
+        if self.size == len(self.array):
+            grown = numpy.full(2 * len(self.array), self.fill, dtype=self.array.dtype)
+            grown[:self.size] = self.array
+            self.array = grown
+        self.array[self.size] = value
+        self.size += 1
+        return self.size - 1
+
+    @property
+    def values(self):
+        """
+        The filled part of the column
+        """
+        return self.array[:self.size]
+
+# Column name to dtype and the value new rows start with
+GROUP_COLUMNS = OrderedDict([('members', (numpy.int64, 0)),
+                             ('founded', (numpy.int64, MISSING)),
+                             ('events', (numpy.int64, 0)),
+                             ('rsvps', (numpy.int64, 0)),
+                             ('upcoming', (numpy.int64, 0)),
+                             ('upcoming_rsvps', (numpy.int64, 0))])
+EVENT_COLUMNS = OrderedDict([('group', (numpy.int32, 0)),
+                             ('time', (numpy.int64, MISSING)),
+                             ('going', (numpy.int32, 0)),
+                             ('past', (numpy.bool_, False))])
+
+def to_epoch_seconds(dt_string):
+    """
+    Convert a Meetup date string to epoch seconds, MISSING if there isn't one
+    """
+    if not dt_string:
+        return MISSING
+    return int(query_meetup.parse_datetime(dt_string).timestamp())
+
+class NetworkStats:
+    """
+    Columnar store of a network's groups and events
+    Rows are in the order first seen, and the id to row dicts keep ids in
+    that order too, so no separate id lists are needed
+    events, rsvps, upcoming and upcoming_rsvps are running totals per group,
+    corrected when an event seen before arrives again with new values
+    """
+    def __init__(self):
+        self.group_index = {}
+        self.names = []
+        self.groups = {name: Column(dtype, fill)
+                       for name, (dtype, fill) in GROUP_COLUMNS.items()}
+        self.event_index = {}
+        self.events = {name: Column(dtype, fill)
+                       for name, (dtype, fill) in EVENT_COLUMNS.items()}
+        # Member counts per group as at each load, for growth
+        self.snapshot_times = []
+        self.snapshots = []
+
+    def group_row(self, group_id):
+        """
+        Row for a group, adding an empty one if it hasn't been seen
+        """
+        row = self.group_index.get(group_id)
+        if row is None:
+            row = len(self.names)
+            self.group_index[group_id] = row
+            self.names.append(None)
+            for column in self.groups.values():
+                column.append(column.fill)
+        return row
+
+    def add_group(self, node):
+        """
+        Add or update a group from a groupsSearch node
+        """
+        row = self.group_row(node['id'])
+        self.names[row] = node.get('name')
+        analytics = node.get('groupAnalytics') or {}
+        self.groups['members'][row] = analytics.get('totalMembers') or 0
+        self.groups['founded'][row] = to_epoch_seconds(node.get('foundedDate'))
+
+    def count_event(self, row, sign):
+        """
+        Add an event's contribution to its group's totals, or remove it
+        """
+        group = self.events['group'][row]
+        going = int(self.events['going'][row])
+        if self.events['past'][row]:
+            self.groups['events'][group] += sign
+            self.groups['rsvps'][group] += sign * going
+        else:
+            self.groups['upcoming'][group] += sign
+            self.groups['upcoming_rsvps'][group] += sign * going
+
+    def add_event(self, node, past):
+        """
+        Add or update an event from an eventsSearch node
+        """
+        group = self.group_row(node['group']['id'])
+        row = self.event_index.get(node['id'])
+        if row is None:
+            row = len(self.event_index)
+            self.event_index[node['id']] = row
+            for column in self.events.values():
+                column.append(column.fill)
+        else:
+            self.count_event(row, -1)
+        self.events['group'][row] = group
+        self.events['time'][row] = to_epoch_seconds(node.get('dateTime'))
+        self.events['going'][row] = node.get('going') or 0
+        self.events['past'][row] = past
+        self.count_event(row, 1)
+
+    def snapshot(self, now=None):
+        """
+        Record every group's member count as at now
+        """
+        self.snapshot_times.append(time.time() if now is None else now)
+        self.snapshots.append(self.groups['members'].values.copy())
+
+    def load(self, meetup, network_url, statuses=None):
+        """
+        Page through a network's groups and events, adding them as they come
+        Only one page of JSON is held at a time
+        """
+        start = time.time()
+        groups = len(self.group_index)
+        for edge in meetup.iter_network_groups(network_url, GROUP_STATS_FIELDS):
+            self.add_group(edge['node'])
+        print(f"Loaded {len(self.group_index) - groups} new groups, "
+              f"{len(self.group_index)} in total")
+        for status in statuses or STATUSES:
+            events = len(self.event_index)
+            for edge in meetup.iter_network_events(network_url, status, EVENT_STATS_FIELDS):
+                self.add_event(edge['node'], status == 'PAST')
+            print(f"Loaded {status.lower()} events, {len(self.event_index) - events} new")
+        self.snapshot()
+        print(f"Network loaded in {time.time() - start:.1f}s")
+
+    def past_stats(self, now=None):
+        """
+        EventStats over every group's past events, in group row order
+        """
+        past = self.events['past'].values & (self.events['time'].values != MISSING)
+        return event_stats.EventStats.from_columns(self.events['group'].values[past],
+                                                   self.events['time'].values[past],
+                                                   len(self.names),
+                                                   now)
+
+    def member_growth(self, days=GROWTH_DAYS):
+        """
+        Change in members per group since the latest snapshot at least days
+        old, or the oldest one if none is that old
+        Returns the changes, NaN for groups not in that snapshot, and the
+        snapshot time, or None without an earlier snapshot
+        """
+        growth = numpy.full(len(self.names), numpy.nan)
+        if len(self.snapshots) < 2:
+            return growth, None
+        cutoff = self.snapshot_times[-1] - days * event_stats.SECONDS_PER_DAY
+        earlier = [index for index, taken in enumerate(self.snapshot_times[:-1])
+                   if taken <= cutoff]
+        index = earlier[-1] if earlier else 0
+        before = self.snapshots[index]
+        members = self.groups['members'].values
+        growth[:len(before)] = members[:len(before)] - before
+        return growth, self.snapshot_times[index]
+
+    def metrics(self, period=PERIOD, growth_days=GROWTH_DAYS, now=None):
+        """
+        Metrics for every group at once, as a list of dicts in row order
+        """
+        now = time.time() if now is None else now
+        stats = self.past_stats(now)
+        events = self.groups['events'].values
+        rsvps = self.groups['rsvps'].values
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            per_event = numpy.where(events > 0, rsvps / events, numpy.nan)
+        last = numpy.full(len(self.names), numpy.nan)
+        has_events = numpy.nonzero(stats.counts)[0]
+        last[has_events] = (now - stats.timestamps[stats.offsets[has_events + 1] - 1]) \
+            / event_stats.SECONDS_PER_DAY
+        founded = self.groups['founded'].values
+        growth, _ = self.member_growth(growth_days)
+        columns = OrderedDict([
+            ('id', list(self.group_index)),
+            ('name', self.names),
+            ('members', self.groups['members'].values.tolist()),
+            ('member_growth', event_stats.to_values(growth)),
+            ('founded', [None if when == MISSING else time.strftime('%Y-%m-%d', time.gmtime(when))
+                         for when in founded.tolist()]),
+            ('events', events.tolist()),
+            ('rsvps', rsvps.tolist()),
+            ('rsvps_per_event', event_stats.to_values(numpy.round(per_event, 1))),
+            ('upcoming', self.groups['upcoming'].values.tolist()),
+            ('upcoming_rsvps', self.groups['upcoming_rsvps'].values.tolist()),
+            ('number_in_period', stats.in_period(period).tolist()),
+            ('trend', stats.trend(period).tolist()),
+            ('event_freq', event_stats.to_values(stats.frequency())),
+            ('median_gap', event_stats.to_values(numpy.round(stats.median_gap(), 1))),
+            ('days_since_event', event_stats.to_values(numpy.floor(last)))])
+        return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+    def summary(self, period=PERIOD, growth_days=GROWTH_DAYS, now=None):
+        """
+        Totals across the whole network
+        """
+        stats = self.past_stats(now)
+        going = self.events['going'].values[self.events['past'].values]
+        growth, since = self.member_growth(growth_days)
+        active = stats.in_period(period)
+        summary = OrderedDict()
+        summary['groups'] = len(self.names)
+        summary['active groups'] = int(numpy.count_nonzero(active))
+        summary['members'] = int(self.groups['members'].values.sum())
+        if since is not None:
+            summary['member growth since ' + time.strftime('%Y-%m-%d', time.localtime(since))] = \
+                int(numpy.nansum(growth))
+        summary['past events'] = len(going)
+        summary[f'events in past {period} months'] = int(active.sum())
+        summary['upcoming events'] = int(self.groups['upcoming'].values.sum())
+        summary['rsvps'] = int(going.sum())
+        if len(going):
+            summary['mean rsvps per event'] = round(float(going.mean()), 1)
+            summary['median rsvps per event'] = float(numpy.median(going))
+        return summary
+
+    def save(self, path):
+        """
+        Save the columns to a compressed .npz file
+        """
+        arrays = {'group_ids': numpy.array(list(self.group_index), dtype=str),
+                  'names': numpy.array([name or '' for name in self.names], dtype=str),
+                  'event_ids': numpy.array(list(self.event_index), dtype=str),
+                  'snapshot_times': numpy.array(self.snapshot_times, dtype=numpy.float64),
+                  'snapshot_sizes': numpy.array([len(members) for members in self.snapshots],
+                                                dtype=numpy.int64),
+                  'snapshot_members': numpy.concatenate(self.snapshots) if self.snapshots
+                                      else numpy.empty(0, dtype=numpy.int64)}
+        for name, column in self.groups.items():
+            arrays['group_' + name] = column.values
+        for name, column in self.events.items():
+            arrays['event_' + name] = column.values
+        # A partly written file never replaces the last good one
+        partial = path + '.partial.npz'
+        numpy.savez_compressed(partial, **arrays)
+        os.replace(partial, path)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Load a network saved by save, or start an empty one
+        """
+        network = cls()
+        if not os.path.isfile(path):
+            return network
+        with numpy.load(path, allow_pickle=False) as arrays:
+            network.group_index = {group_id: row for row, group_id
+                                   in enumerate(arrays['group_ids'].tolist())}
+            network.names = [name or None for name in arrays['names'].tolist()]
+            network.event_index = {event_id: row for row, event_id
+                                   in enumerate(arrays['event_ids'].tolist())}
+            network.groups = {name: Column(dtype, fill, arrays['group_' + name])
+                              for name, (dtype, fill) in GROUP_COLUMNS.items()}
+            network.events = {name: Column(dtype, fill, arrays['event_' + name])
+                              for name, (dtype, fill) in EVENT_COLUMNS.items()}
+            network.snapshot_times = arrays['snapshot_times'].tolist()
+            sizes = arrays['snapshot_sizes']
+            if len(sizes):
+                network.snapshots = numpy.split(arrays['snapshot_members'],
+                                                numpy.cumsum(sizes)[:-1])
+        print(f"Loaded {len(network.names)} groups and {len(network.event_index)} "
+              f"events from {path}")
+        return network
+
+def columns():
+    '''
+    Output columns of the per group metrics
+    '''
+    return OrderedDict([('Name', 'name'),
+                        ('Members', 'members'),
+                        ('Member growth', 'member_growth'),
+                        ('Founded', 'founded'),
+                        ('Past events', 'events'),
+                        ('RSVPs per event', 'rsvps_per_event'),
+                        ('Upcoming', 'upcoming'),
+                        ('Events in period', 'number_in_period'),
+                        ('Trend', 'trend'),
+                        ('Event frequency', 'event_freq'),
+                        ('Median gap', 'median_gap'),
+                        ('Days since event', 'days_since_event')])
+
+def config_handler():
+    '''
+    Manage network analytics configuration parsing
+    '''
+    parser = argparse.ArgumentParser(description='Analyse a Meetup.com Pro network')
+    parser.add_argument('--config',
+                        action="store",
+                        help='configuration file',
+                        required=True)
+    parser.add_argument('--network',
+                        action="store",
+                        help='urlname of the Pro network, overriding the config')
+    args = parser.parse_args()
+    if not os.path.isfile(args.config):
+        print(f"Could not find config file {args.config}")
+        sys.exit(1)
+    cfg = query_meetup.load_config(args.config)
+    network_cfg = cfg.get('network') or {}
+    cfg['network'] = network_cfg
+    if args.network:
+        network_cfg['urlname'] = args.network
+    if not network_cfg.get('urlname'):
+        print("No network urlname given in the config or with --network")
+        sys.exit(1)
+    return args, cfg
+
+def main():
+    """
+    Main execution
+    """
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args, cfg = config_handler()
+    network_cfg = cfg['network']
+    period = network_cfg.get('period', PERIOD)
+    growth_days = network_cfg.get('growth_days', GROWTH_DAYS)
+
+    meetup_conn = query_meetup.MSMeetup(args.config, cfg=cfg)
+    info = meetup_conn.get_network(network_cfg['urlname'])
+    print(f"Analysing network {info['name']}")
+
+    path = network_cfg.get('store', network_cfg['urlname'] + '.' + STORE + '.npz')
+    network = NetworkStats.open(path)
+    network.load(meetup_conn, network_cfg['urlname'], network_cfg.get('statuses', STATUSES))
+    network.save(path)
+
+    summary = PrettyTable(['Network', info['name']])
+    summary.align = 'l'
+    for name, value in network.summary(period, growth_days).items():
+        summary.add_row([name, value])
+    print(summary)
+
+    # Most active groups first
+    metrics = sorted(network.metrics(period, growth_days),
+                     key=lambda group: (group['number_in_period'], group['events']),
+                     reverse=True)
+    output_cfg = network_cfg.get('output') or {'types': ['table']}
+    outputs = exporters.create_exporters(output_cfg['types'],
+                                         output_cfg.get('name', network_cfg['urlname']),
+                                         columns())
+    exporters.export(outputs, metrics)
+    meetup_conn.close()
+
+if __name__ == "__main__":
+    main()
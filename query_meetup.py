@@ -5,26 +5,183 @@ Query meetup.com API
 
 import time
 import sys
-import datetime
+import json
+import asyncio
+import operator
+import re
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime
 from dateutil.parser import parse
-import pytz
 import yaml
 import xlsxwriter
 import geocoder
 import os
 from prettytable import PrettyTable
+import response_cache
+import gazetteer
+import event_stats
+import records
+import replay
 
 BASE_API_URL = 'https://api.meetup.com/gql'
 ACCESS_URL = 'https://secure.meetup.com/oauth2/access'
 AUTH_URL = 'https://secure.meetup.com/oauth2/authorize'
 DEBUG = False
+DEDUPE_KEY = 'id'
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 10
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+FETCH_MODE = 'sync'
+REQUESTS_PER_SECOND = 2
+RATE_BURST = 1
+# The adaptive limiter recovers to the configured rate, and only goes up to
+# this multiple of it when X-RateLimit headers show the server has room
+MAX_RATE_MULTIPLIER = 4
+# Fraction of the starting rate added back after each successful request
+RATE_INCREASE = 0.1
+# Fraction the rate is cut to after a 429 or 5xx response
+RATE_DECREASE = 0.5
+MAX_CONCURRENCY = 8
+BATCH_SIZE = 1
+PAGE_SIZE = 100
+MAX_ITEMS = None
+CACHE_ENABLED = True
+CHECKPOINT_EVERY = 20
+# Groups gathered by the filter pipeline before loading their event data
+PIPELINE_CHUNK = 1000
+GEOCODE_CACHE_ENABLED = True
+GEOCODE_OFFLINE = False
+NAME_WORD_BOUNDARY = False
+# Seconds before expiry that an OAuth token is refreshed
+TOKEN_REFRESH_MARGIN = 300
+# Filter pipeline cost from which a filter needs data from the API
+API_COST = 10
 
-def de_dupe(groups):
+# Fields requested for each aliased group in a batched query
+GROUP_FIELDS = """
+                name
+                link
+                city
+                country
+                memberships {
+                    count
+                }"""
+EVENT_COUNT_FIELDS = """
+                pastEvents(input: {}) {
+                    count
+                }"""
+PROFILE_FIELDS = """
+                name
+                memberships {
+                    count
+                }
+                pastEvents(input: {}) {
+                    count
+                    pageInfo {
+                        hasNextPage
+                        endCursor
+                    }
+                    edges {
+                        node {
+                            dateTime
+                        }
+                    }
+                }"""
+EVENT_DATETIME_FIELDS = """
+                pastEvents(input: {}) {
+                    pageInfo {
+                        hasNextPage
+                        endCursor
+                    }
+                    edges {
+                        node {
+                            dateTime
+                        }
+                    }
+                }"""
+# Fields requested for each network event and group
+NETWORK_EVENT_FIELDS = """
+                            id
+                            group {
+                                id
+                            }
+                            title
+                            eventUrl
+                            dateTime
+                            description
+                            timezone
+                            going"""
+NETWORK_GROUP_FIELDS = """
+                            id
+                            name
+                            foundedDate
+                            groupAnalytics {
+                                totalMembers
+                                totalPastEvents
+                                totalPastRsvps
+                                averageRsvpsPerEvent
+                                }"""
+
+def load_config(configfile):
+    """
+    Load a YAML config file
+    """
+    with open(configfile, 'r', encoding='utf-8') as ymlfile:
+        try:
+            return yaml.safe_load(ymlfile)
+        except yaml.YAMLError as exc:
+            print("Error parsing configuration file")
+            if hasattr(exc, 'problem_mark'):
+                mark = exc.problem_mark # pylint: disable=no-member
+                print(f"Config file does not seem to be correct YAML - \
+                        error at line {mark.line}, column {mark.column}")
+            sys.exit(1)
+
+class QueryError(Exception):
+    """
+    A GraphQL query failed, as opposed to finding nothing
+    """
+
+def error_messages(res):
+    """
+    The error messages from a GraphQL response, joined into one string
+    """
+    return '; '.join(error.get('message', '') for error in res.get('errors') or [])
+
+class DeDuper:
+    """
+    Streaming de-duplication stage, keeping the first group seen per identity
+    key is a group field name or a function returning a hashable identity
+    """
+    def __init__(self, key=DEDUPE_KEY):
+        self.key = key if callable(key) else operator.itemgetter(key)
+        self.seen = set()
+        self.duplicates = {}
+
+    def filter(self, groups, source=None):
+        """
+        Yield only groups not seen before, counting duplicates per source
+        """
+        for group in groups:
+            identity = self.key(group)
+            if identity in self.seen:
+                self.duplicates[source] = self.duplicates.get(source, 0) + 1
+                continue
+            self.seen.add(identity)
+            yield group
+
+def de_dupe(groups, key=DEDUPE_KEY):
     """
     De-duplicate a set of groups
     """
-    deduped = [i for n, i in enumerate(groups) if i not in groups[n+1:]]
+    deduped = list(DeDuper(key).filter(groups))
     return deduped
 
 def exclude_by_country(groups, country):
@@ -37,63 +194,90 @@ def exclude_by_country(groups, country):
 def event_frequency(datetimes):
     """
     Given a set of datetimes calculate the average frequency of events in days
+    Returns None if there are fewer than two events
     """
-    timedeltas = [datetimes[i+1]-datetimes[i] for i in range(0, len(datetimes)-1, 1)]
-    average_timedelta = sum(timedeltas, datetime.timedelta(0)) / len(timedeltas)
-    return average_timedelta.days
+    stats = event_stats.EventStats([event_stats.to_epoch(datetimes)])
+    return event_metrics(stats, None)[0]['event_freq']
 
 def number_in_period(datetimes, period):
     """
     Given a set of datetimes calculate the number of events within a period
     Not wildly accurate given days in month varies
     """
-    count = 0
-    # Assume period is in months, so convert to days
-    days = period * 30.436875
-    # Handle timezone awareness
-    time_start = datetime.datetime.now(pytz.utc) - datetime.timedelta(days=days)
-    for i in range(0, len(datetimes), 1):
-        if datetimes[i] > time_start:
-            count += 1
-    return count
+    stats = event_stats.EventStats([event_stats.to_epoch(datetimes)])
+    return int(stats.in_period(period)[0])
+
+def event_metrics(stats, period):
+    """
+    Compute event metrics for every group in an EventStats at once
+    Returns a dict of metrics per group, period metrics only if period is set
+    """
+    freq = event_stats.to_values(stats.frequency())
+    median_gap = event_stats.to_values(stats.median_gap())
+    metrics = [{'event_freq': None if days is None else int(days),
+                'median_gap': None if gap is None else round(gap, 1)}
+               for days, gap in zip(freq, median_gap)]
+    if period is not None:
+        for metric, count, trend in zip(metrics,
+                                        stats.in_period(period).tolist(),
+                                        stats.trend(period).tolist()):
+            metric['number_in_period'] = count
+            metric['trend'] = trend
+    return metrics
+
+class SpreadsheetWriter:
+    """
+    Streaming spreadsheet writer with a worksheet per country
+    Uses xlsxwriter's constant memory mode so each row is flushed to disk as
+    it is written, and column widths are tracked as rows arrive
+    """
+    def __init__(self, name, columns):
+        # sanitise name from config
+        if not name.endswith('.xlsx'):
+            name = name+".xlsx"
+        self.workbook = xlsxwriter.Workbook(name, {'constant_memory': True})
+        self.columns = columns
+        # country -> [worksheet, next row, column widths]
+        self.sheets = {}
+
+    def add(self, group):
+        """
+        Write a group as the next row of its country's worksheet
+        """
+        sheet = self.sheets.get(group['country'])
+        if sheet is None:
+            worksheet = self.workbook.add_worksheet(group['country'])
+            # Set the values for initial column widths from the column headings length
+            sheet = [worksheet, 1, add_columns(self.workbook, worksheet, self.columns.keys())]
+            self.sheets[group['country']] = sheet
+        worksheet, row, col_widths = sheet
+        for col, item in enumerate(self.columns.values()):
+            value = group[item]
+            # Update the column widths as we go, set to the widest item
+            length = len(value) if isinstance(value, str) else len(str(value))
+            if length > col_widths[col]:
+                col_widths[col] = length
+            worksheet.write(row, col, value)
+        sheet[1] += 1
+
+    def close(self):
+        """
+        Set column widths to display properly and write the workbook
+        """
+        for worksheet, _, col_widths in self.sheets.values():
+            for col, value in enumerate(col_widths):
+                worksheet.set_column(col, col, value + 1)
+        self.workbook.close()
 
 def create_spreadsheet(name, columns, groups):
     """
     Create a spreadsheet from a set of groups and column headers
+    groups can be any iterable, it is only read once
     """
-    # sanitise name from config
-    if not name.endswith('.xlxs'):
-        name = name+".xlsx"
-    workbook = xlsxwriter.Workbook(name)
-    row_count = {}
-    col_widths = {}
+    writer = SpreadsheetWriter(name, columns)
     for group in groups:
-        current_sheet = workbook.get_worksheet_by_name(group['country'])
-        if not current_sheet:
-            current_sheet = workbook.add_worksheet(group['country'])
-            # Set the values for initial column widths from the column headings length
-            col_widths[group['country']] = add_columns(workbook, current_sheet, columns.keys())
-            row_count[group['country']] = 0
-        col = 0
-        for item in columns.values():
-            # Update the column widths dictionary as we iterate through
-            # Set it to widest item
-            if isinstance(group[item], int):
-                length = len(str(group[item]))
-            else:
-                length = len(group[item])
-            if length > col_widths[group['country']][col]:
-                col_widths[group['country']][col] = length
-            current_sheet.write(row_count[group['country']] + 1, col, group[item])
-            col += 1
-        # store the current row per sheet in case data is out of order
-        row_count[group['country']] += 1
-    # Set column widths to display properly
-    for sheet, values in col_widths.items():
-        current_sheet = workbook.get_worksheet_by_name(sheet)
-        for col, value in enumerate(values):
-            current_sheet.set_column(col, col, value + 1)
-    workbook.close()
+        writer.add(group)
+    writer.close()
 
 def add_columns(workbook, worksheet, columns):
     """
@@ -120,15 +304,218 @@ def create_table(columns, groups):
         table.add_row(row)
     return table
 
+class LazyTable:
+    """
+    A table of groups only rendered if it is actually logged
+    Pass it to logging.debug in place of create_table
+    """
+    def __init__(self, columns, groups):
+        self.columns = columns
+        self.groups = groups
+
+    def __str__(self):
+        return str(create_table(self.columns, self.groups))
+
+def format_group(group, group_id):
+    """
+    Flatten a group response into the Group record used throughout the filters
+    """
+    return records.Group(group_id,
+                         name=group['name'],
+                         link=group['link'],
+                         city=group['city'],
+                         country=group['country'],
+                         members=group['memberships']['count'])
+
+def parse_datetime(dt_string):
+    """
+    Convert a Meetup dateTime string such as 2023-03-14T18:30+01:00
+    Meetup always sends ISO 8601 with a TZ offset, which fromisoformat reads
+    far faster than dateutil, so parse is only used for anything else
+    """
+    try:
+        return datetime.fromisoformat(dt_string)
+    except ValueError:
+        return parse(dt_string)
+
+def parse_datetimes(past_events):
+    """
+    Convert the dateTime strings of a pastEvents response into datetimes
+    """
+    return [parse_datetime(item['node']['dateTime'])
+            for item in past_events['edges']]
+
+def format_profile(group, group_id):
+    """
+    Flatten a group profile response into name, counts and event datetimes
+    """
+    return {'id': group_id,
+            'name': group['name'],
+            'members': group['memberships']['count'],
+            'number_events': group['pastEvents']['count'],
+            'datetimes': parse_datetimes(group['pastEvents'])}
+
+def create_session(pool_connections=POOL_CONNECTIONS,
+                   pool_maxsize=POOL_MAXSIZE,
+                   max_retries=MAX_RETRIES,
+                   backoff_factor=BACKOFF_FACTOR):
+    """
+    Create a connection pooled, keep-alive HTTP session with retry/backoff
+    """
+    # Queries are read only, so it is safe to retry POSTs as well as GETs.
+    # Only connection errors are retried here, 429/5xx responses are left to
+    # graphql_query so the rate limiter can see them and back off. urllib3
+    # would otherwise sleep out Retry-After and retry those itself
+    retries = Retry(total=max_retries,
+                    status=0,
+                    backoff_factor=backoff_factor,
+                    status_forcelist=[],
+                    allowed_methods=None,
+                    respect_retry_after_header=False,
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize,
+                          max_retries=retries)
+    session = requests.Session()
+    session.headers.update({'Connection': 'keep-alive'})
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+class TokenBucket:
+    """
+    Thread safe token bucket shared by every in-flight API request
+    """
+    def __init__(self, rate, capacity=RATE_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and take it
+        Returns the number of seconds spent waiting
+        """
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+class AdaptiveRateLimiter(TokenBucket):
+    """
+    Token bucket whose rate follows what the server allows
+    Backs off exponentially on 429/5xx responses, honours Retry-After and
+    X-RateLimit-* headers, and ramps back up to the configured rate while
+    requests succeed, going beyond it only when the headers allow
+    """
+    def __init__(self, rate, capacity=RATE_BURST, backoff_factor=BACKOFF_FACTOR):
+        super().__init__(rate, capacity)
+        self.base_rate = rate
+        self.min_rate = rate * RATE_DECREASE ** 5
+        self.max_rate = rate * MAX_RATE_MULTIPLIER
+        self.step = rate * RATE_INCREASE
+        self.backoff_factor = backoff_factor
+        self.failures = 0
+        self.blocked_until = 0
+        self.stats = {'throttled': 0.0, 'working': 0.0, 'requests': 0, 'backoffs': 0}
+
+    def acquire(self):
+        """
+        Wait out any backoff in force, then take a token
+        """
+        with self.lock:
+            pause = self.blocked_until - time.monotonic()
+        waited = 0
+        if pause > 0:
+            time.sleep(pause)
+            waited = pause
+        waited += super().acquire()
+        with self.lock:
+            self.stats['throttled'] += waited
+        return waited
+
+    def record(self, response, elapsed):
+        """
+        Adjust the rate from a response, returning True if it should be retried
+        """
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['working'] += elapsed
+            if response.status_code in RETRY_STATUSES:
+                self.failures += 1
+                self.stats['backoffs'] += 1
+                self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+                pause = self.backoff_factor * 2 ** (self.failures - 1)
+                retry_after = response.headers.get('Retry-After')
+                if retry_after and retry_after.isdigit():
+                    pause = max(pause, int(retry_after))
+                self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+                return True
+            self.failures = 0
+            ceiling = self.base_rate
+            allowed = None
+            remaining = response.headers.get('X-RateLimit-Remaining')
+            reset = response.headers.get('X-RateLimit-Reset')
+            if remaining and reset and remaining.isdigit() and reset.isdigit():
+                # Spread what's left of the window evenly until it resets
+                allowed = int(remaining) / max(int(reset), 1)
+                ceiling = min(self.max_rate, max(ceiling, allowed))
+            self.rate = min(ceiling, self.rate + self.step)
+            if allowed is not None:
+                self.rate = max(self.min_rate, min(self.rate, allowed))
+            return False
+
+    def report(self):
+        """
+        Summarise time spent throttled versus making requests
+        """
+        return (f"API requests: {self.stats['requests']} "
+                f"Backoffs: {self.stats['backoffs']} "
+                f"Time throttled: {self.stats['throttled']:.1f}s "
+                f"Time working: {self.stats['working']:.1f}s "
+                f"Current rate: {self.rate:.2f}/s")
+
 class MSMeetup:
     """
     Define class object and load config
     """
-    def __init__(self, configfile):
+    def __init__(self, configfile, record_dir=None, replay_dir=None, cfg=None):
         env_vars = 'MEETUP_CLIENT_ID,MEETUP_CLIENT_SECRET'.split(',')
         self.base_api_url = BASE_API_URL
         self.access_url = ACCESS_URL
         self.debug = DEBUG
+        self.async_mode = FETCH_MODE == 'async'
+        self.max_concurrency = MAX_CONCURRENCY
+        self.batch_size = BATCH_SIZE
+        self.page_size = PAGE_SIZE
+        self.max_items = MAX_ITEMS
+        self.cache = None
+        self.geocache = None
+        self.gazetteer = None
+        self.geocode_offline = GEOCODE_OFFLINE
+        self.max_retries = MAX_RETRIES
+        self.rate_limiter = AdaptiveRateLimiter(REQUESTS_PER_SECOND)
+        self.oauth_headers = {'Accept': 'application/json'}
+        self.recorder = None
+        self.replayer = None
+        self.oauth_refresh_token = None
+        self.token_expires = None
+        # Held while refreshing, so concurrent workers only refresh once
+        self.token_lock = threading.Lock()
+        # Calls, bytes and seconds of API traffic per kind of query
+        self.api_stats = {}
+        self.stats_lock = threading.Lock()
 
         if configfile is None:
             for evar in env_vars:
@@ -137,25 +524,101 @@ class MSMeetup:
                     sys.exit(1)
             self.client_id = os.environ['MEETUP_CLIENT_ID']
             self.client_secret = os.environ['MEETUP_CLIENT_SECRET']
+            self.session = create_session()
+            self.set_recording(record_dir, replay_dir)
         else:
-            with open(configfile, 'r', encoding='utf-8') as ymlfile:
-                try:
-                    cfg = yaml.safe_load(ymlfile)
-                except yaml.YAMLError as exc:
-                    print("Error parsing configuration file")
-                    if hasattr(exc, 'problem_mark'):
-                        mark = exc.problem_mark # pylint: disable=no-member
-                        print(f"Config file does not seem to be correct YAML - \
-                                error at line {mark.line}, column {mark.column}")
-                    sys.exit(1)
+            # Callers that have already loaded the config can pass it in
+            if cfg is None:
+                cfg = load_config(configfile)
             if "meetup" not in cfg:
                 print("Invalid configuration file")
                 sys.exit(1)
             self.client_id = cfg['meetup']['client_id']
             self.client_secret = cfg['meetup']['client_secret']
-            if 'oauth_type' in cfg['meetup'] and cfg['meetup']['oauth_type'] == 'anon':
+            self.session = create_session(
+                cfg['meetup'].get('pool_connections', POOL_CONNECTIONS),
+                cfg['meetup'].get('pool_maxsize', POOL_MAXSIZE),
+                cfg['meetup'].get('max_retries', MAX_RETRIES),
+                cfg['meetup'].get('backoff_factor', BACKOFF_FACTOR))
+            self.async_mode = cfg['meetup'].get('fetch_mode', FETCH_MODE) == 'async'
+            self.max_concurrency = cfg['meetup'].get('max_concurrency', MAX_CONCURRENCY)
+            self.batch_size = cfg['meetup'].get('batch_size', BATCH_SIZE)
+            self.page_size = cfg['meetup'].get('page_size', PAGE_SIZE)
+            self.max_items = cfg['meetup'].get('max_items', MAX_ITEMS)
+            self.max_retries = cfg['meetup'].get('max_retries', MAX_RETRIES)
+            # Fall back on the old seconds between queries setting for the rate
+            rate = REQUESTS_PER_SECOND
+            if (cfg.get('groups') or {}).get('api_rate_limit'):
+                rate = 1 / cfg['groups']['api_rate_limit']
+            self.rate_limiter = AdaptiveRateLimiter(
+                cfg['meetup'].get('requests_per_second', rate),
+                cfg['meetup'].get('rate_burst', RATE_BURST),
+                cfg['meetup'].get('backoff_factor', BACKOFF_FACTOR))
+            if cfg['meetup'].get('cache', CACHE_ENABLED):
+                self.cache = response_cache.ResponseCache(
+                    cfg['meetup'].get('cache_path', configfile + '.cache.db'),
+                    cfg['meetup'].get('cache_ttls'),
+                    cfg['meetup'].get('cache_max_entries', response_cache.MAX_ENTRIES))
+            groups_cfg = cfg.get('groups') or {}
+            if groups_cfg.get('geocode_cache', GEOCODE_CACHE_ENABLED):
+                self.geocache = response_cache.GeocodeCache(
+                    groups_cfg.get('geocode_cache_path', configfile + '.geo.db'))
+            if groups_cfg.get('gazetteer'):
+                self.gazetteer = gazetteer.Gazetteer(groups_cfg['gazetteer'],
+                                                     groups_cfg.get('locations'))
+            self.geocode_offline = groups_cfg.get('geocode_offline', GEOCODE_OFFLINE)
+            self.base_api_url = cfg['meetup'].get('base_api_url', BASE_API_URL)
+            self.set_recording(record_dir or cfg['meetup'].get('record_dir'),
+                               replay_dir or cfg['meetup'].get('replay_dir'))
+            # A replayed run never talks to Meetup, so doesn't need a token
+            if self.replayer is None and cfg['meetup'].get('oauth_type') == 'anon':
                 self.oauth_headers = self.get_oauth_token(cfg)
 
+    def close(self):
+        """
+        Print rate limiter, connection, API and cache statistics, then close
+        the caches, recording and HTTP session
+        """
+        print(self.rate_limiter.report())
+        stats = self.connection_stats()
+        print(f"HTTP requests: {stats['requests']} "
+              f"Connections opened: {stats['connections']} "
+              f"Connections reused: {stats['reused']}")
+        for kind, api_stats in sorted(self.api_stats.items()):
+            print(f"API {kind}: calls {api_stats['calls']} "
+                  f"bytes {api_stats['bytes']} "
+                  f"time {api_stats['seconds']:.1f}s")
+        if self.cache:
+            print(self.cache.report())
+            self.cache.close()
+        if self.geocache:
+            print(self.geocache.report())
+            self.geocache.close()
+        if self.recorder:
+            self.recorder.close()
+        if self.replayer:
+            print(self.replayer.report())
+        self.session.close()
+
+    def set_recording(self, record_dir=None, replay_dir=None):
+        """
+        Record API responses to a directory, or replay them from one
+        """
+        if record_dir and replay_dir:
+            raise ValueError('Cannot record and replay at the same time')
+        if record_dir:
+            self.recorder = replay.Recorder(record_dir)
+        if replay_dir:
+            self.replayer = replay.Replayer(replay_dir)
+
+    def cap_cache_ttls(self, max_age):
+        """
+        Stop the response cache serving anything older than max_age seconds,
+        so refreshing stale data really goes to the API
+        """
+        if self.cache and max_age is not None:
+            self.cache.cap_ttls(max_age)
+
     def get_oauth_token(self, cfg):
         """
         Get an Oauth token
@@ -167,10 +630,10 @@ class MSMeetup:
                        'redirect_uri': cfg['meetup']['redirect_uri']}
         print("Attempting to authenticate against Meetup.com")
         try:
-            auth_response = requests.get(cfg['meetup']['auth_url'],
-                                         params=auth_params,
-                                         headers=headers,
-                                         timeout=30)
+            auth_response = self.session.get(cfg['meetup']['auth_url'],
+                                             params=auth_params,
+                                             headers=headers,
+                                             timeout=30)
         except requests.exceptions.RequestException as error:
             raise SystemExit(error) from error
         auth_token = auth_response.json()["code"]
@@ -181,16 +644,49 @@ class MSMeetup:
                          'redirect_uri': cfg['meetup']['redirect_uri'],
                          'code': auth_token}
         try:
-            access_response = requests.post(self.access_url,
-                                            params=access_params,
-                                            headers=headers,
-                                            timeout=30)
+            access_response = self.session.post(self.access_url,
+                                                 params=access_params,
+                                                 headers=headers,
+                                                 timeout=30)
         except requests.exceptions.RequestException as error:
             raise SystemExit(error) from error
-        access_token = access_response.json()["access_token"]
-        auth_string = f'bearer {access_token}'
-        oauth_headers = {'Accept': 'application/json', 'Authorization': auth_string}
-        return oauth_headers
+        return self.set_token(access_response.json())
+
+    def set_token(self, token):
+        """
+        Keep the refresh token and expiry from a token response
+        Returns the headers that authorise requests with its access token
+        """
+        if token.get('refresh_token'):
+            self.oauth_refresh_token = token['refresh_token']
+        self.token_expires = None
+        if token.get('expires_in'):
+            self.token_expires = time.time() + int(token['expires_in'])
+        auth_string = f'bearer {token["access_token"]}'
+        return {'Accept': 'application/json', 'Authorization': auth_string}
+
+    def token_due(self, margin=TOKEN_REFRESH_MARGIN):
+        """
+        Seconds until the token should be refreshed, or None if it can't be
+        """
+        if self.token_expires is None or self.oauth_refresh_token is None:
+            return None
+        return self.token_expires - margin - time.time()
+
+    def ensure_token(self, margin=TOKEN_REFRESH_MARGIN):
+        """
+        Refresh the token if it expires within margin seconds
+        """
+        due = self.token_due(margin)
+        # The expiry is updated before the headers, so wait for any refresh
+        # in progress to finish even when the token already looks fresh
+        if due is None or (due > 0 and not self.token_lock.locked()):
+            return
+        with self.token_lock:
+            # Another worker may have refreshed it while this one waited
+            due = self.token_due(margin)
+            if due is not None and due <= 0:
+                self.refresh_token(self.oauth_refresh_token)
 
     def refresh_token(self, refresh_token):
         """
@@ -203,16 +699,13 @@ class MSMeetup:
                           'grant_type':'refresh_token',
                           'refresh_token':refresh_token}
         try:
-            access_response = requests.post(self.access_url,
-                                            params=refresh_params,
-                                            headers=headers,
-                                            timeout=30)
+            access_response = self.session.post(self.access_url,
+                                                 params=refresh_params,
+                                                 headers=headers,
+                                                 timeout=30)
         except requests.exceptions.RequestException as error:
             raise SystemExit(error) from error
-        access_token = access_response.json()["access_token"]
-        auth_string = f'bearer {access_token}'
-        oauth_headers = {'Accept': 'application/json', 'Authorization': auth_string}
-        self.oauth_headers = oauth_headers
+        self.oauth_headers = self.set_token(access_response.json())
 
     def auth_jwt(self, jwt):
         """
@@ -223,26 +716,183 @@ class MSMeetup:
                        'assertion': jwt}
         print("Attempting to authenticate against Meetup.com")
         try:
-            access_response = requests.post(self.access_url,
-                                            params=auth_params,
-                                            headers=headers,
-                                            timeout=30)
+            access_response = self.session.post(self.access_url,
+                                                 params=auth_params,
+                                                 headers=headers,
+                                                 timeout=30)
         except requests.exceptions.RequestException as error:
             raise SystemExit(error) from error
-        access_token = access_response.json()["access_token"]
-        auth_string = f'bearer {access_token}'
-        oauth_headers = {'Accept': 'application/json', 'Authorization': auth_string}
-        self.oauth_headers = oauth_headers
+        self.oauth_headers = self.set_token(access_response.json())
 
     def graphql_query(self, query, variables):
         """
         Query the GraphQL API
+        Responses are served from the cache while they are still fresh
+        """
+        if self.replayer:
+            return self.replayer.get(query, variables)
+        if self.cache:
+            kind = response_cache.query_kind(query)
+            key = response_cache.cache_key(query, variables)
+            cached = self.cache.get(kind, key)
+            if cached is not None:
+                if self.recorder:
+                    self.recorder.put(query, variables, cached)
+                return cached
+        for _ in range(self.max_retries + 1):
+            # Runs can outlast the token, so check it before every request
+            self.ensure_token()
+            self.rate_limiter.acquire()
+            started = time.monotonic()
+            res = self.session.post(self.base_api_url,
+                                    json={'query': query, 'variables': variables},
+                                    headers=self.oauth_headers,
+                                    timeout=30)
+            elapsed = time.monotonic() - started
+            self.count_call(query, len(res.content), elapsed)
+            if not self.rate_limiter.record(res, elapsed):
+                break
+        result = res.json()
+        # Never cache partial or failed responses
+        if self.cache and result.get('data') and not result.get('errors'):
+            self.cache.put(kind, key, result)
+        if self.recorder:
+            self.recorder.put(query, variables, result)
+        return result
+
+    def count_call(self, query, size, elapsed):
+        """
+        Account for an API call in api_stats
+        """
+        kind = response_cache.query_kind(query)
+        with self.stats_lock:
+            stats = self.api_stats.setdefault(kind, {'calls': 0, 'bytes': 0, 'seconds': 0.0})
+            stats['calls'] += 1
+            stats['bytes'] += size
+            stats['seconds'] += elapsed
+
+    def fetch_concurrent(self, func, items):
+        """
+        Call func for every item with many requests in flight at once
+        Results are returned in the same order as items
+        """
+        return asyncio.run(self._gather(func, list(items)))
+
+    async def _gather(self, func, items):
+        """
+        Schedule func over items on a worker pool bounded by max_concurrency
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def worker(executor, item):
+            async with semaphore:
+                return await loop.run_in_executor(executor, func, item)
+
+        # requests is blocking, so the session calls run on threads and the
+        # token bucket in graphql_query paces them
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            return await asyncio.gather(*(worker(executor, item) for item in items))
+
+    def connection_stats(self):
+        """
+        Return counters showing how well the session is reusing connections
+        """
+        stats = {'requests': 0, 'connections': 0}
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats['requests'] += pool.num_requests
+                stats['connections'] += pool.num_connections
+        stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+        return stats
+
+    def paginate(self, query, variables, path, after=None, max_items=None):
+        """
+        Lazily yield edges from a connection, following endCursor page by page
+        The query must accept $first: Int and $after: String
+        Raises QueryError if a page fails, so a failure isn't mistaken for
+        the end of the results
+        """
+        if max_items is None:
+            max_items = self.max_items
+        count = 0
+        while True:
+            page_variables = dict(variables, first=self.page_size, after=after)
+            res = self.graphql_query(query, json.dumps(page_variables))
+            connection = res.get('data')
+            for key in path:
+                if connection is None:
+                    break
+                connection = connection.get(key)
+            if connection is None:
+                if res.get('errors') or 'data' not in res:
+                    raise QueryError(error_messages(res) or 'no data in response')
+                # A missing group or network has nothing to page through
+                return
+            if res.get('errors'):
+                print(f"Partial results for {'.'.join(path)}: {error_messages(res)}")
+            for edge in connection['edges']:
+                if max_items is not None and count >= max_items:
+                    return
+                count += 1
+                yield edge
+            page_info = connection['pageInfo']
+            if not page_info.get('hasNextPage') or not page_info.get('endCursor'):
+                return
+            after = page_info['endCursor']
+
+    def lookup_city(self, geonames_user, city, country):
         """
-        res = requests.post(self.base_api_url,
-                            json={'query': query, 'variables': variables},
-                            headers=self.oauth_headers,
-                            timeout=30)
-        return res.json()
+        Get a city's lat and lon, from a recording if replaying
+        """
+        if self.replayer:
+            return self.replayer.get_geocode(city, country)
+        lat, lon = get_lat_lon(geonames_user,
+                               city,
+                               country,
+                               self.geocache,
+                               self.gazetteer,
+                               self.geocode_offline)
+        if self.recorder and all([lat, lon]):
+            self.recorder.put_geocode(city, country, lat, lon)
+        return lat, lon
+
+    def iter_search_for_groups(self,
+                               geonames_user,
+                               city,
+                               country,
+                               radius,
+                               search_string):
+        """
+        Search for groups, yielding group ids as each page arrives
+        """
+        lat, lon = self.lookup_city(geonames_user, city, country)
+        if not all([lat, lon]):
+            return
+        query = """query ($search_string: String!, $lat: Float!, $lon: Float!, $radius: Int!,
+                          $first: Int, $after: String) {
+            keywordSearch(filter: { query: $search_string, lat: $lat, lon: $lon, radius: $radius, source: GROUPS },
+                          input: { first: $first, after: $after }) {
+                count
+                pageInfo {
+                    hasNextPage
+                    endCursor
+                }
+                edges {
+                    node {
+                        id
+                    }
+                }
+            }
+        }"""
+        variables = {'search_string': search_string,
+                     'lat': lat,
+                     'lon': lon,
+                     'radius': radius}
+        for edge in self.paginate(query, variables, ['keywordSearch']):
+            yield edge['node']['id']
 
     def search_for_groups(self,
                           geonames_user,
@@ -253,35 +903,27 @@ class MSMeetup:
         """
         Search for groups
         """
-        lat, lon = get_lat_lon(geonames_user, city, country)
-        if all([lat, lon]):
-            query = """query ($search_string: String!, $lat: Float!, $lon: Float!, $radius: Int!) {
-                keywordSearch(filter: { query: $search_string, lat: $lat, lon: $lon, radius: $radius, source: GROUPS }) {
-                    count
-                    pageInfo {
-                        endCursor
-                    }
-                    edges {
-                        node {
-                            id
-                        }
-                    }
-                }
-            }"""
-            variables = f'{{"search_string": "{search_string}",\
-                    "lat": {lat},\
-                    "lon": {lon},\
-                    "radius": {radius}}}'
-            res = self.graphql_query(query, variables)
-            ids = [x for y in [item['node'].values()
-                               for item in res['data']['keywordSearch']['edges']]
-                   for x in y]
-            return ids
-        return []
+        return list(self.iter_search_for_groups(geonames_user,
+                                                city,
+                                                country,
+                                                radius,
+                                                search_string))
+
+    @staticmethod
+    def group_data(res, group_id):
+        """
+        The group from a single group query, or None if it couldn't be read,
+        for example a private or deleted group
+        """
+        group = (res.get('data') or {}).get('group')
+        if group is None:
+            messages = error_messages(res)
+            print(f"Could not fetch group {group_id}, skipping it: {messages or 'not found'}")
+        return group
 
     def get_group(self, group_id):
         """
-        Retrieve the group info
+        Retrieve the group info, None if it couldn't be fetched
         """
         query = """query ($groupid: ID!) {
             group(id: $groupid) {
@@ -295,15 +937,58 @@ class MSMeetup:
              }
           }"""
         variables = f'{{"groupid": "{group_id}"}}'
+        group = self.group_data(self.graphql_query(query, variables), group_id)
+        return None if group is None else format_group(group, group_id)
+
+    def batch_query(self, fields, group_ids):
+        """
+        Query many groups per request by aliasing group(id:) once per id
+        Returns a dict of group id to group data, None where that alias failed
+        """
+        # Sorted so the same ids always make the same chunks, whatever order
+        # they were found in, letting cached and recorded responses match
+        group_ids = sorted(group_ids)
+        chunks = [group_ids[start:start + self.batch_size]
+                  for start in range(0, len(group_ids), self.batch_size)]
+        if self.async_mode:
+            responses = self.fetch_concurrent(lambda chunk: self.query_chunk(fields, chunk),
+                                              chunks)
+        else:
+            responses = [self.query_chunk(fields, chunk) for chunk in chunks]
+        results = {}
+        for response in responses:
+            results.update(response)
+        return results
+
+    def query_chunk(self, fields, group_ids):
+        """
+        Run a single aliased query for a chunk of group ids
+        """
+        params = ', '.join(f'$id{n}: ID!' for n in range(len(group_ids)))
+        aliases = ''.join(f"""
+            g{n}: group(id: $id{n}) {{{fields}
+            }}""" for n in range(len(group_ids)))
+        query = f"""query ({params}) {{{aliases}
+          }}"""
+        variables = json.dumps({f'id{n}': group_id for n, group_id in enumerate(group_ids)})
         res = self.graphql_query(query, variables)
-        res['data']['group']['id'] = group_id
-        res['data']['group']['members'] = res['data']['group']['memberships']['count']
-        del res['data']['group']['memberships']
-        return res['data']['group']
+        data = res.get('data') or {}
+        # Errors are reported per alias, so one bad group doesn't sink the chunk
+        for error in res.get('errors', []):
+            print(f"Batched query error for {error.get('path')}: {error.get('message')}")
+        return {group_id: data.get(f'g{n}') for n, group_id in enumerate(group_ids)}
+
+    def get_groups(self, group_ids):
+        """
+        Retrieve the group info for many groups
+        """
+        res = self.batch_query(GROUP_FIELDS, group_ids)
+        return {group_id: format_group(group, group_id) if group else None
+                for group_id, group in res.items()}
 
     def get_number_of_events(self, group_id):
         """
-        Retrieve the number of events for a group
+        Retrieve the number of events for a group, None if it couldn't be fetched
         """
         query = """query ($groupid: ID!) {
             group(id: $groupid) {
@@ -321,75 +1006,119 @@ class MSMeetup:
             }
           }"""
         variables = f'{{"groupid": "{group_id}"}}'
-        res = self.graphql_query(query, variables)
-        return res['data']['group']['pastEvents']['count']
+        group = self.group_data(self.graphql_query(query, variables), group_id)
+        return None if group is None else group['pastEvents']['count']
 
-    def get_network_events(self,
-                           network_url,
-                           status):
+    def get_number_of_events_batch(self, group_ids):
         """
-        Get events from a network
+        Retrieve the number of events for many groups
+        """
+        res = self.batch_query(EVENT_COUNT_FIELDS, group_ids)
+        return {group_id: group['pastEvents']['count'] if group else None
+                for group_id, group in res.items()}
+
+    def get_group_profile(self, group_id):
+        """
+        Retrieve everything the event filters need for a group in one query
+        Returns None if the group couldn't be fetched
         """
-        query = """query ($urlname: String!, $status: ProNetworkEventStatus) {
+        query = """query ($groupid: ID!) {
+            group(id: $groupid) {""" + PROFILE_FIELDS + """
+            }
+          }"""
+        variables = f'{{"groupid": "{group_id}"}}'
+        group = self.group_data(self.graphql_query(query, variables), group_id)
+        if group is None:
+            return None
+        profile = format_profile(group, group_id)
+        if self.complete_event_datetimes(group_id,
+                                         group['pastEvents'],
+                                         profile['datetimes']) is None:
+            return None
+        profile['timestamps'] = event_stats.to_epoch(profile.pop('datetimes'))
+        return profile
+
+    def get_group_profiles_batch(self, group_ids):
+        """
+        Retrieve the group profile for many groups
+        """
+        res = self.batch_query(PROFILE_FIELDS, group_ids)
+        profiles = {}
+        for group_id, group in res.items():
+            profiles[group_id] = None
+            if group:
+                profile = format_profile(group, group_id)
+                if self.complete_event_datetimes(group_id,
+                                                 group['pastEvents'],
+                                                 profile['datetimes']) is None:
+                    continue
+                profile['timestamps'] = event_stats.to_epoch(profile.pop('datetimes'))
+                profiles[group_id] = profile
+        return profiles
+
+    def iter_network_events(self,
+                            network_url,
+                            status,
+                            fields=NETWORK_EVENT_FIELDS):
+        """
+        Yield events from a network, following pagination
+        fields can narrow what is fetched for each event
+        """
+        query = """query ($urlname: String!, $status: ProNetworkEventStatus,
+                          $first: Int, $after: String) {
             proNetworkByUrlname(urlname: $urlname) {
-                eventsSearch(filter: { status: $status }, input: { first: 100 }) {
+                eventsSearch(filter: { status: $status }, input: { first: $first, after: $after }) {
                     count
                     pageInfo {
+                        hasNextPage
                         endCursor
                     }
                     edges {
-                        node {
-                            id
-                            group {
-                                id
-                            }
-                            title
-                            eventUrl
-                            dateTime
-                            description
-                            timezone
-                            going
+                        node {""" + fields + """
                         }
                     }
                 }
             }
         }"""
-        variables = f'{{"urlname": "{network_url}",\
-                        "status": "{status}"}}'
-        res = self.graphql_query(query, variables)
-        return res['data']['proNetworkByUrlname']['eventsSearch']['edges']
-    
+        variables = {'urlname': network_url, 'status': status}
+        yield from self.paginate(query, variables, ['proNetworkByUrlname', 'eventsSearch'])
 
-    def get_network_groups(self, network_url):
+    def get_network_events(self,
+                           network_url,
+                           status):
         """
-        Get groups from a network
+        Get events from a network
         """
-        query = """query ($urlname: String!) {
+        return list(self.iter_network_events(network_url, status))
+
+    def iter_network_groups(self, network_url, fields=NETWORK_GROUP_FIELDS):
+        """
+        Yield groups from a network, following pagination
+        fields can narrow what is fetched for each group
+        """
+        query = """query ($urlname: String!, $first: Int, $after: String) {
             proNetworkByUrlname(urlname: $urlname) {
-                groupsSearch(input: { first: 100 }) {
+                groupsSearch(input: { first: $first, after: $after }) {
                     count
                     pageInfo {
+                        hasNextPage
                         endCursor
                     }
                     edges {
-                        node {
-                            id
-                            name
-                            foundedDate
-                            groupAnalytics {
-                                totalMembers
-                                totalPastEvents
-                                totalPastRsvps
-                                averageRsvpsPerEvent
-                                }
+                        node {""" + fields + """
                         }
                     }
                 }
             }
         }"""
-        variables = f'{{"urlname": "{network_url}"}}'
-        res = self.graphql_query(query, variables)
-        return res['data']['proNetworkByUrlname']['groupsSearch']['edges']
+        variables = {'urlname': network_url}
+        yield from self.paginate(query, variables, ['proNetworkByUrlname', 'groupsSearch'])
+
+    def get_network_groups(self, network_url):
+        """
+        Get groups from a network
+        """
+        return list(self.iter_network_groups(network_url))
 
     def get_network(self, network_url):
         """
@@ -408,15 +1137,16 @@ class MSMeetup:
         res = self.graphql_query(query, variables)
         return res['data']['proNetworkByUrlname']
     
-    def get_members(self, group_id):
+    def iter_members(self, group_id):
         """
-        Retrieve the members of a group
+        Yield the members of a group, following pagination
         """
-        query = """query ($groupid: ID!) {
+        query = """query ($groupid: ID!, $first: Int, $after: String) {
             group(id: $groupid) {
-                memberships {
+                memberships(input: { first: $first, after: $after }) {
                     count
                     pageInfo {
+                        hasNextPage
                         endCursor
                     }
                     edges {
@@ -428,19 +1158,25 @@ class MSMeetup:
                }
             }
           }"""
-        variables = f'{{"groupid": "{group_id}"}}'
-        res = self.graphql_query(query, variables)
-        return res
+        variables = {'groupid': group_id}
+        yield from self.paginate(query, variables, ['group', 'memberships'])
 
-    def get_event_datetimes(self, group_id):
+    def get_members(self, group_id):
         """
-        Get a list of datetimes for events
+        Retrieve the members of a group
         """
-        query = """query ($groupid: ID!) {
+        return list(self.iter_members(group_id))
+
+    def iter_event_datetimes(self, group_id, after=None):
+        """
+        Yield datetimes for past events, following pagination
+        """
+        query = """query ($groupid: ID!, $first: Int, $after: String) {
             group(id: $groupid) {
-                pastEvents(input: {}) {
+                pastEvents(input: { first: $first, after: $after }) {
                     count
                     pageInfo {
+                        hasNextPage
                         endCursor
                     }
                     edges {
@@ -451,38 +1187,105 @@ class MSMeetup:
                }
             }
           }"""
-        variables = f'{{"groupid": "{group_id}"}}'
-        res = self.graphql_query(query, variables)
-        datetime_strings = [x for y in [item['node'].values()
-                                        for item in
-                                        res['data']['group']['pastEvents']['edges']]
-                            for x in y]
-        # These are unicode strings so convert them to datetimes
-        datetimes = []
-        for dt_string in datetime_strings:
-            # Use parse as strptime doesn't support TZ offsets
-            date_time = parse(dt_string)
-            datetimes.append(date_time)
+        variables = {'groupid': group_id}
+        for edge in self.paginate(query, variables, ['group', 'pastEvents'], after):
+            yield parse_datetime(edge['node']['dateTime'])
+
+    def get_event_datetimes(self, group_id):
+        """
+        Get a list of datetimes for events, None if they couldn't be fetched
+        """
+        try:
+            return list(self.iter_event_datetimes(group_id))
+        except QueryError as error:
+            print(f"Could not fetch events for group {group_id}, skipping it: {error}")
+            return None
+
+    def complete_event_datetimes(self, group_id, past_events, datetimes):
+        """
+        Follow pastEvents beyond the first page returned by a combined query
+        Returns None if a later page couldn't be fetched
+        """
+        page_info = past_events.get('pageInfo') or {}
+        if page_info.get('hasNextPage') and page_info.get('endCursor'):
+            try:
+                datetimes.extend(self.iter_event_datetimes(group_id, page_info['endCursor']))
+            except QueryError as error:
+                print(f"Could not fetch all events for group {group_id}, skipping it: {error}")
+                return None
+        return datetimes
+
+    def get_event_datetimes_batch(self, group_ids):
+        """
+        Get lists of event datetimes for many groups
+        """
+        res = self.batch_query(EVENT_DATETIME_FIELDS, group_ids)
+        datetimes = {}
+        for group_id, group in res.items():
+            datetimes[group_id] = None
+            if group:
+                datetimes[group_id] = self.complete_event_datetimes(
+                    group_id,
+                    group['pastEvents'],
+                    parse_datetimes(group['pastEvents']))
         return datetimes
 
-def filter_on_name(search_keys, groups):
+class NameMatcher:
+    """
+    Search keys compiled once into a single case insensitive regex, so each
+    group name is scanned once rather than once per key
+    With word_boundary keys only match whole words, and a name containing
+    any exclude keyword never matches
+    """
+    def __init__(self, search_keys, word_boundary=NAME_WORD_BOUNDARY, exclude=None):
+        self.pattern = self.compile(search_keys, word_boundary)
+        self.exclude = self.compile(exclude, word_boundary) if exclude else None
+
+    @staticmethod
+    def compile(keys, word_boundary):
+        """
+        Build one alternation of all keys, longest first
+        """
+        if not keys:
+            # Nothing to match, as with the old per key loop
+            return re.compile(r'(?!)')
+        keys = sorted(set(keys), key=len, reverse=True)
+        alternation = '|'.join(re.escape(key) for key in keys)
+        if word_boundary:
+            # Lookarounds rather than \b so keys like C++ still match
+            alternation = rf"(?<!\w)(?:{alternation})(?!\w)"
+        return re.compile(alternation, re.IGNORECASE)
+
+    def match(self, name):
+        """
+        Check whether a group name matches the search keys
+        """
+        if self.exclude is not None and self.exclude.search(name):
+            return False
+        return self.pattern.search(name) is not None
+
+@functools.lru_cache(maxsize=32)
+def name_matcher(search_keys, word_boundary=NAME_WORD_BOUNDARY, exclude=None):
+    """
+    Return a compiled NameMatcher, reused for the same keys and options
+    """
+    return NameMatcher(search_keys, word_boundary, exclude)
+
+def filter_on_name(search_keys, groups, word_boundary=NAME_WORD_BOUNDARY, exclude=None):
     """
     Return a filtered set of groups based on name matching
     Meetup API search scope is full description not just name
     """
-    name_matches = [group for group in groups
-                    if any(key.lower() in group["name"].lower()
-                           for key in search_keys)]
+    matcher = name_matcher(tuple(search_keys), word_boundary, tuple(exclude or ()))
+    name_matches = [group for group in groups if matcher.match(group["name"])]
     return name_matches
 
-def check_name_filter(search_keys, group):
+def check_name_filter(search_keys, group, word_boundary=NAME_WORD_BOUNDARY, exclude=None):
     """
     Check a group against the search keys
     """
-    for key in search_keys:
-        if key.lower() in group["name"].lower():
-            return True
-    return False
+    matcher = name_matcher(tuple(search_keys), word_boundary, tuple(exclude or ()))
+    return matcher.match(group["name"])
 
 def filter_on_members(filters, groups):
     """
@@ -492,54 +1295,415 @@ def filter_on_members(filters, groups):
                   if group["members"] > filters['member_filter'][1]]
     return mem_filter
 
-def filter_on_events(meetup, filters, groups, rate_limit):
+def fetch_for_groups(meetup, func, group_ids, batch_func=None):
+    """
+    Call func for each group id, batched and/or concurrently if enabled
+    Groups that can't be fetched, even on their own, are returned as None
+    """
+    if meetup.batch_size > 1 and batch_func:
+        batched = batch_func(group_ids)
+        # Retry any ids whose alias failed in the batch one at a time
+        return [batched[group_id] if batched.get(group_id) is not None
+                else func(group_id)
+                for group_id in group_ids]
+    if meetup.async_mode:
+        return meetup.fetch_concurrent(func, group_ids)
+    results = []
+    for group_id in group_ids:
+        results.append(func(group_id))
+    return results
+
+def load_profiles(store, group_ids, max_age, need_datetimes=True):
+    """
+    Return event profiles from the datastore checked within max_age seconds
+    """
+    now = time.time()
+    fresh = {}
+    for group_id, (profile, checked) in store.get_profiles(group_ids).items():
+        if now - checked > max_age:
+            continue
+        # Profiles stored before timestamps were kept are fetched again
+        if profile.get('timestamps') is None:
+            if need_datetimes:
+                continue
+        else:
+            profile['timestamps'] = event_stats.from_list(profile['timestamps'])
+        fresh[group_id] = profile
+    return fresh
+
+def save_profiles(store, profiles):
+    """
+    Store event profiles in the datastore for later incremental runs
+    """
+    serialised = {}
+    for profile in profiles:
+        # Groups that couldn't be fetched are tried again next time
+        if profile is None:
+            continue
+        profile = dict(profile)
+        if profile.get('timestamps') is not None:
+            profile['timestamps'] = event_stats.to_list(profile['timestamps'])
+        serialised[profile['id']] = profile
+    store.put_profiles(serialised)
+
+def fetch_profiles(meetup,
+                   group_ids,
+                   store=None,
+                   max_age=None,
+                   need_datetimes=True):
+    """
+    Return event profiles for group ids, reusing fresh ones from the datastore
+    and only querying the API for new or stale groups
+    Stored profiles are only reused when max_age is set, but fetched ones are
+    always saved to the store so an interrupted run can resume
+    Without need_datetimes only the cheaper event count query is used
+    Groups that couldn't be fetched get None
+    """
+    profiles = {}
+    if store is not None and max_age is not None:
+        profiles = load_profiles(store, group_ids, max_age, need_datetimes)
+        if profiles:
+            print(f"Reusing stored event data for {len(profiles)} groups")
+    missing = [group_id for group_id in group_ids if group_id not in profiles]
+    # Save profiles as each chunk arrives so an interrupted run can resume
+    chunk_size = len(missing) or 1
+    if store is not None:
+        chunk_size = max(CHECKPOINT_EVERY, meetup.batch_size * meetup.max_concurrency)
+    for start in range(0, len(missing), chunk_size):
+        chunk = missing[start:start + chunk_size]
+        if need_datetimes:
+            fetched = fetch_for_groups(meetup,
+                                       meetup.get_group_profile,
+                                       chunk,
+                                       meetup.get_group_profiles_batch)
+        else:
+            counts = fetch_for_groups(meetup,
+                                      meetup.get_number_of_events,
+                                      chunk,
+                                      meetup.get_number_of_events_batch)
+            fetched = [None if number_events is None else
+                       {'id': group_id, 'number_events': number_events, 'timestamps': None}
+                       for group_id, number_events in zip(chunk, counts)]
+        if store is not None:
+            save_profiles(store, fetched)
+        profiles.update(zip(chunk, fetched))
+    return [profiles[group_id] for group_id in group_ids]
+
+def filter_on_events(meetup, filters, groups, store=None, max_age=None):
     """
     Return a filtered set of groups based on minimum number of events
     """
-    for group in groups:
-        group["number_events"] = meetup.get_number_of_events(group['id'])
-        time.sleep(rate_limit)
-    num_event_filter = [group for group in groups
-                        if group["number_events"] > filters['event_filter'][1]]
+    results = fetch_profiles(meetup,
+                             [group['id'] for group in groups],
+                             store,
+                             max_age,
+                             need_datetimes=False)
+    num_event_filter = []
+    for group, profile in zip(groups, results):
+        if profile is None:
+            continue
+        group["number_events"] = profile['number_events']
+        if group["number_events"] > filters['event_filter'][1]:
+            num_event_filter.append(group)
     return num_event_filter
 
-def filter_on_period(meetup, filters, groups, rate_limit):
+def filter_on_period(meetup, filters, groups):
     """
     Return a filtered set of groups based on events in past configurable period
     """
-    for group in groups:
-        group["number_in_period"] = number_in_period(meetup.get_event_datetimes(group['id']),
-                                                     filters['period_filter'][1])
+    results = fetch_for_groups(meetup,
+                               meetup.get_event_datetimes,
+                               [group['id'] for group in groups],
+                               meetup.get_event_datetimes_batch)
+    # Groups whose events couldn't be fetched are left out
+    fetched = [(group, datetimes) for group, datetimes in zip(groups, results)
+               if datetimes is not None]
+    groups = [group for group, _ in fetched]
+    stats = event_stats.EventStats([event_stats.to_epoch(datetimes)
+                                    for _, datetimes in fetched])
+    for group, count in zip(groups, stats.in_period(filters['period_filter'][1]).tolist()):
+        group["number_in_period"] = count
         group["period"] = filters['period_filter'][1]
-        time.sleep(rate_limit)
     period_event_filter = [group for group in groups
                            if group["number_in_period"]
                            > filters['period_filter'][2]]
     return period_event_filter
 
-def filter_on_freq(meetup, filters, groups, rate_limit):
+def filter_on_freq(meetup, filters, groups):
     """
     Return a filtered set based on a configurable past event frequency
     """
-    for group in groups:
-        datetimes = meetup.get_event_datetimes(group['id'])
-        group["event_freq"] = event_frequency(datetimes)
-        time.sleep(rate_limit)
+    results = fetch_for_groups(meetup,
+                               meetup.get_event_datetimes,
+                               [group['id'] for group in groups],
+                               meetup.get_event_datetimes_batch)
+    # Groups whose events couldn't be fetched are left out
+    fetched = [(group, datetimes) for group, datetimes in zip(groups, results)
+               if datetimes is not None]
+    groups = [group for group, _ in fetched]
+    stats = event_stats.EventStats([event_stats.to_epoch(datetimes)
+                                    for _, datetimes in fetched])
+    for group, metric in zip(groups, event_metrics(stats, None)):
+        group["event_freq"] = metric['event_freq']
+    # Groups with fewer than two events have no frequency
     event_freq_filter = [group for group in groups
-                         if group["event_freq"]
-                         < filters['freq_filter'][1]]
+                         if group["event_freq"] is not None
+                         and group["event_freq"] < filters['freq_filter'][1]]
     return event_freq_filter
 
-def get_lat_lon(geonames_user, city, country):
+def load_event_data(meetup,
+                    groups,
+                    need_datetimes=True,
+                    period=None,
+                    store=None,
+                    max_age=None):
+    """
+    Fetch event profiles for groups and store the event count, and if
+    need_datetimes the event metrics, on each group
+    Metrics for all groups are worked out in one vectorised pass
+    Returns the groups whose event data could be fetched
+    """
+    profiles = fetch_profiles(meetup,
+                              [group['id'] for group in groups],
+                              store,
+                              max_age,
+                              need_datetimes)
+    fetched = [(group, profile) for group, profile in zip(groups, profiles)
+               if profile is not None]
+    if len(fetched) < len(groups):
+        print(f"Skipping {len(groups) - len(fetched)} groups whose event data "
+              "couldn't be fetched")
+    groups = [group for group, _ in fetched]
+    profiles = [profile for _, profile in fetched]
+    for group, profile in fetched:
+        group["number_events"] = profile['number_events']
+    if not need_datetimes:
+        return groups
+    stats = event_stats.EventStats([profile['timestamps'] for profile in profiles])
+    for group, metrics in zip(groups, event_metrics(stats, period)):
+        for field, value in metrics.items():
+            group[field] = value
+        if period is not None:
+            group["period"] = period
+    return groups
+
+class GroupFilter:
+    """
+    A stage of the filter pipeline
+    cost orders the pipeline, cheapest first. Filters costing API_COST or
+    more need data from the API, named by fields, which the pipeline loads
+    only for groups that got through every cheaper filter
+    """
+    name = None
+    cost = 0
+    fields = ()
+
+    def check(self, group):
+        """
+        Return True to keep the group
+        """
+        raise NotImplementedError
+
+class NameFilter(GroupFilter):
+    """
+    Keep groups whose name contains a search key
+    """
+    name = 'name'
+    cost = 0
+    fields = ('name',)
+
+    def __init__(self, search_keys, word_boundary=NAME_WORD_BOUNDARY, exclude=None):
+        self.matcher = NameMatcher(search_keys, word_boundary, exclude)
+
+    def check(self, group):
+        return self.matcher.match(group["name"])
+
+class MemberFilter(GroupFilter):
+    """
+    Keep groups with more than min_members members
+    """
+    name = 'members'
+    cost = 1
+    fields = ('members',)
+
+    def __init__(self, min_members):
+        self.min_members = min_members
+
+    def check(self, group):
+        return group["members"] > self.min_members
+
+class EventFilter(GroupFilter):
+    """
+    Keep groups with more than min_events past events
+    """
+    name = 'events'
+    cost = API_COST
+    fields = ('number_events',)
+
+    def __init__(self, min_events):
+        self.min_events = min_events
+
+    def check(self, group):
+        return group["number_events"] > self.min_events
+
+class PeriodFilter(GroupFilter):
+    """
+    Keep groups with more than min_events events in the past period months
+    """
+    name = 'period'
+    cost = API_COST + 1
+    fields = ('number_events', 'timestamps')
+
+    def __init__(self, period, min_events):
+        self.period = period
+        self.min_events = min_events
+
+    def check(self, group):
+        return group["number_in_period"] > self.min_events
+
+class FreqFilter(GroupFilter):
+    """
+    Keep groups averaging fewer than max_days days between events
+    Groups with fewer than two events have no frequency so are dropped
+    """
+    name = 'freq'
+    cost = API_COST + 2
+    fields = ('number_events', 'timestamps')
+
+    def __init__(self, max_days):
+        self.max_days = max_days
+
+    def check(self, group):
+        return group["event_freq"] is not None and group["event_freq"] < self.max_days
+
+class FilterPipeline:
+    """
+    Run groups through filters in cost order, stopping at the first
+    filter that rejects each group, and count what each filter removed
+    """
+    def __init__(self, filters):
+        self.filters = sorted(filters, key=operator.attrgetter('cost'))
+        self.stats = {group_filter.name: {'checked': 0, 'eliminated': 0, 'seconds': 0.0}
+                      for group_filter in self.filters}
+        self.load_seconds = 0.0
+
+    def passes(self, filters, group):
+        """
+        Check a group against filters in order, stopping at the first that
+        rejects it
+        """
+        for group_filter in filters:
+            stats = self.stats[group_filter.name]
+            start = time.perf_counter()
+            keep = group_filter.check(group)
+            stats['seconds'] += time.perf_counter() - start
+            stats['checked'] += 1
+            if not keep:
+                stats['eliminated'] += 1
+                return False
+        return True
+
+    def apply(self, filters, groups):
+        """
+        Return the groups passing every filter given
+        """
+        return [group for group in groups if self.passes(filters, group)]
+
+    def iter_run(self, meetup, groups, store=None, max_age=None, chunk_size=PIPELINE_CHUNK):
+        """
+        Lazily filter groups, yielding each one that passes
+        Groups passing the local filters are gathered into chunks of
+        chunk_size, so API data is still loaded and worked out in bulk
+        """
+        local = [group_filter for group_filter in self.filters
+                 if group_filter.cost < API_COST]
+        remote = [group_filter for group_filter in self.filters
+                  if group_filter.cost >= API_COST]
+        if not remote:
+            for group in groups:
+                if self.passes(local, group):
+                    yield group
+            return
+        chunk = []
+        for group in groups:
+            if self.passes(local, group):
+                chunk.append(group)
+                if len(chunk) >= chunk_size:
+                    yield from self.apply_remote(meetup, remote, chunk, store, max_age)
+                    chunk = []
+        if chunk:
+            yield from self.apply_remote(meetup, remote, chunk, store, max_age)
+
+    def apply_remote(self, meetup, remote, groups, store, max_age):
+        """
+        Load API data for a chunk of groups and run the remote filters on it
+        """
+        fields = {field for group_filter in remote for field in group_filter.fields}
+        period = next((group_filter.period for group_filter in remote
+                       if isinstance(group_filter, PeriodFilter)), None)
+        start = time.perf_counter()
+        groups = load_event_data(meetup,
+                                 groups,
+                                 'timestamps' in fields,
+                                 period,
+                                 store,
+                                 max_age)
+        self.load_seconds += time.perf_counter() - start
+        return self.apply(remote, groups)
+
+    def run(self, meetup, groups, store=None, max_age=None):
+        """
+        Filter groups into a list, only loading API data for groups passing
+        local filters
+        """
+        return list(self.iter_run(meetup, groups, store, max_age))
+
+    def report(self):
+        """
+        Table of groups checked and eliminated, and time taken, per filter
+        """
+        table = PrettyTable(['Filter', 'Cost', 'Checked', 'Eliminated', 'Seconds'])
+        for group_filter in self.filters:
+            stats = self.stats[group_filter.name]
+            table.add_row([group_filter.name,
+                           group_filter.cost,
+                           stats['checked'],
+                           stats['eliminated'],
+                           f"{stats['seconds']:.3f}"])
+        if self.load_seconds:
+            table.add_row(['(loading event data)', API_COST, '', '', f"{self.load_seconds:.3f}"])
+        return table
+
+def get_lat_lon(geonames_user,
+                city,
+                country,
+                geocache=None,
+                places=None,
+                offline=False):
     """
     Get a city's lat and lon using Geonames
+    Checks the local gazetteer and geocode cache first, and only goes to
+    the Geonames API if neither has the city and we're not offline
     """
+    if places:
+        coords = places.lookup(city, country)
+        if coords:
+            return coords
+    if geocache:
+        coords = geocache.get(city, country)
+        if coords:
+            return coords
+    if offline:
+        print(f"No offline Geocode results found for {city} {country}")
+        return False, False
     try:
         geodata = geocoder.geonames(city, country=country, key=geonames_user)
     except requests.exceptions.RequestException as error:
         print("Could not connect to geocoding API - exiting")
         raise SystemExit(error) from error
     if geodata.ok:
+        if geocache:
+            geocache.put(city, country, geodata.lat, geodata.lng)
         return geodata.lat, geodata.lng
     print(f"No Geocode results found for {city} {country}")
     return False, False
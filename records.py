@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Compact records for group data fetched from meetup.com
+"""
+
+class Group:
+    """
+    A Meetup group and the results of any filters run against it
+    Uses __slots__ rather than a per instance dict to keep memory down, but
+    still supports group['name'] style access so it can stand in for the
+    flattened response dicts used throughout the filters and outputs
+    Groups are equal, and hash, by id
+    """
+    __slots__ = ('id',
+                 'name',
+                 'link',
+                 'city',
+                 'country',
+                 'members',
+                 'fetched',
+                 'number_events',
+                 'number_in_period',
+                 'period',
+                 'trend',
+                 'event_freq',
+                 'median_gap')
+
+    def __init__(self, group_id, **fields):
+        self.id = group_id # pylint: disable=invalid-name
+        for field in self.__slots__[1:]:
+            setattr(self, field, fields.get(field))
+
+    def __getitem__(self, field):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in self.__slots__ and getattr(self, field) is not None
+
+    def __eq__(self, other):
+        if not isinstance(other, Group):
+            return NotImplemented
+        return self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"Group({self.to_dict()!r})"
+
+    def get(self, field, default=None):
+        """
+        Return a field, or default if it isn't set
+        """
+        value = getattr(self, field, None) if field in self.__slots__ else None
+        return default if value is None else value
+
+    def keys(self):
+        """
+        Names of the fields that are set, so dict(group) works
+        """
+        return [field for field in self.__slots__ if getattr(self, field) is not None]
+
+    def to_dict(self):
+        """
+        Plain dict of the fields that are set, for JSON serialisation
+        """
+        return {field: getattr(self, field) for field in self.keys()}
+
+    def copy(self):
+        """
+        Return a separate copy of the group
+        """
+        return Group(self.id, **self.to_dict())
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Build a group from a dict, ignoring any fields it doesn't know
+        Groups are passed through unchanged
+        """
+        if isinstance(data, cls):
+            return data
+        return cls(data['id'], **data)
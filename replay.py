@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Record API responses to disk and replay them without touching the network
+"""
+
+import os
+import json
+import threading
+import response_cache
+
+GRAPHQL_FILE = 'graphql.jsonl'
+GEOCODE_FILE = 'geocode.jsonl'
+
+def geocode_key(city, country):
+    """
+    Key a recorded geocode by city and country, ignoring case
+    """
+    return f"{city.lower()}|{str(country).lower()}"
+
+class Recorder:
+    """
+    Append every GraphQL response and geocode seen to JSON lines files in a
+    directory, keyed the same way as the response cache
+    """
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.recorded = 0
+        # Responses arrive from the worker threads used in async mode
+        self.lock = threading.Lock()
+        self.graphql = open(os.path.join(path, GRAPHQL_FILE), 'a', encoding='utf-8') # pylint: disable=consider-using-with
+        self.geocode = open(os.path.join(path, GEOCODE_FILE), 'a', encoding='utf-8') # pylint: disable=consider-using-with
+
+    def put(self, query, variables, result):
+        """
+        Record a GraphQL response
+        """
+        line = json.dumps({'key': response_cache.cache_key(query, variables),
+                           'kind': response_cache.query_kind(query),
+                           'result': result})
+        with self.lock:
+            self.graphql.write(line + '\n')
+            self.recorded += 1
+
+    def put_geocode(self, city, country, lat, lon):
+        """
+        Record a city's coordinates
+        """
+        line = json.dumps({'key': geocode_key(city, country), 'lat': lat, 'lon': lon})
+        with self.lock:
+            self.geocode.write(line + '\n')
+
+    def close(self):
+        """
+        Close the recording files
+        """
+        self.graphql.close()
+        self.geocode.close()
+        print(f"Recorded {self.recorded} responses to {self.path}")
+
+class Replayer:
+    """
+    Serve GraphQL responses and geocodes from a directory written by Recorder
+    Anything that wasn't recorded is a hard error, so a replayed run never
+    silently falls back to the live API
+    """
+    def __init__(self, path):
+        self.path = path
+        self.responses = {}
+        self.geocodes = {}
+        self.replayed = 0
+        self.lock = threading.Lock()
+        graphql_path = os.path.join(path, GRAPHQL_FILE)
+        geocode_path = os.path.join(path, GEOCODE_FILE)
+        if not os.path.isfile(graphql_path):
+            raise SystemExit(f"No recorded responses found in {path}")
+        with open(graphql_path, 'r', encoding='utf-8') as recording:
+            for line in recording:
+                entry = json.loads(line)
+                self.responses[entry['key']] = entry['result']
+        if os.path.isfile(geocode_path):
+            with open(geocode_path, 'r', encoding='utf-8') as recording:
+                for line in recording:
+                    entry = json.loads(line)
+                    self.geocodes[entry['key']] = (entry['lat'], entry['lon'])
+        print(f"Loaded {len(self.responses)} recorded responses from {path}")
+
+    def get(self, query, variables):
+        """
+        Return the recorded response to a GraphQL query
+        """
+        key = response_cache.cache_key(query, variables)
+        if key not in self.responses:
+            raise SystemExit(f"No recorded response for {response_cache.query_kind(query)} "
+                             f"query with variables {variables}")
+        with self.lock:
+            self.replayed += 1
+        return self.responses[key]
+
+    def get_geocode(self, city, country):
+        """
+        Return the recorded coordinates of a city
+        """
+        coords = self.geocodes.get(geocode_key(city, country))
+        if coords is None:
+            print(f"No recorded Geocode results found for {city} {country}")
+            return False, False
+        return coords
+
+    def report(self):
+        """
+        Summary of responses replayed
+        """
+        return f"Replayed {self.replayed} of {len(self.responses)} recorded responses"
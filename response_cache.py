@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+Persistent TTL/LRU cache for meetup.com API responses
+"""
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+MAX_ENTRIES = 100000
+# Seconds each kind of response stays fresh
+TTLS = {'group': 7 * 86400,
+        'search': 86400,
+        'events': 6 * 3600,
+        'network': 6 * 3600,
+        'other': 3600}
+
+def query_kind(query):
+    """
+    Classify a GraphQL query so it can be given the right TTL
+    """
+    if 'proNetworkByUrlname' in query:
+        return 'network'
+    if 'keywordSearch' in query:
+        return 'search'
+    if 'pastEvents' in query:
+        return 'events'
+    if 'group(' in query:
+        return 'group'
+    return 'other'
+
+def cache_key(query, variables):
+    """
+    Build a stable key from a query and its variables
+    """
+    if isinstance(variables, str):
+        variables = json.loads(variables)
+    payload = json.dumps({'query': ' '.join(query.split()), 'variables': variables},
+                         sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """
+    SQLite backed response cache with per kind TTLs and LRU eviction
+    """
+    def __init__(self, path, ttls=None, max_entries=MAX_ENTRIES):
+        self.ttls = dict(TTLS, **(ttls or {}))
+        self.max_entries = max_entries
+        self.stats = {}
+        self.evicted = 0
+        # Shared by the worker threads used in async mode
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                 key TEXT PRIMARY KEY,
+                                 kind TEXT NOT NULL,
+                                 value TEXT NOT NULL,
+                                 created REAL NOT NULL,
+                                 accessed REAL NOT NULL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed "
+                          "ON responses (accessed)")
+        self.size = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def cap_ttls(self, max_age):
+        """
+        Keep no kind of response longer than max_age seconds
+        """
+        self.ttls = {kind: min(ttl, max_age) for kind, ttl in self.ttls.items()}
+
+    def count(self, kind, stat):
+        """
+        Increment a hit/miss counter for a kind of query
+        """
+        counters = self.stats.setdefault(kind, {'hits': 0, 'misses': 0, 'expired': 0})
+        counters[stat] += 1
+
+    def get(self, kind, key):
+        """
+        Return a cached response, or None if missing or expired
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, created FROM responses WHERE key = ?",
+                                    (key,)).fetchone()
+            if row is None:
+                self.count(kind, 'misses')
+                return None
+            if now - row[1] > self.ttls.get(kind, self.ttls['other']):
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.size -= 1
+                self.count(kind, 'expired')
+                self.count(kind, 'misses')
+                return None
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.count(kind, 'hits')
+        return json.loads(row[0])
+
+    def put(self, kind, key, value):
+        """
+        Store a response, evicting the least recently used if over size
+        """
+        now = time.time()
+        with self.lock:
+            exists = self.conn.execute("SELECT 1 FROM responses WHERE key = ?",
+                                       (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses "
+                              "(key, kind, value, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                              (key, kind, json.dumps(value), now, now))
+            if not exists:
+                self.size += 1
+            if self.size > self.max_entries:
+                evicted = self.conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                    (self.size - self.max_entries,)).rowcount
+                self.size -= evicted
+                self.evicted += evicted
+
+    def report(self):
+        """
+        Summarise hit/miss statistics per kind of query
+        """
+        lines = []
+        for kind, counters in sorted(self.stats.items()):
+            lines.append(f"Cache {kind}: hits {counters['hits']} "
+                         f"misses {counters['misses']} "
+                         f"expired {counters['expired']}")
+        lines.append(f"Cache evictions: {self.evicted}")
+        return '\n'.join(lines)
+
+    def close(self):
+        """
+        Close the cache
+        """
+        self.conn.close()
+
+class GeocodeCache:
+    """
+    Persistent (city, country) to lat/lon cache, cities don't move so no TTL
+    """
+    def __init__(self, path):
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS geocodes (
+                                 city TEXT NOT NULL,
+                                 country TEXT NOT NULL,
+                                 lat REAL NOT NULL,
+                                 lon REAL NOT NULL,
+                                 PRIMARY KEY (city, country))""")
+        self.conn.commit()
+
+    def get(self, city, country):
+        """
+        Return cached (lat, lon) for a city, or None
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT lat, lon FROM geocodes "
+                                    "WHERE city = ? AND country = ?",
+                                    (city.lower(), str(country).upper())).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row
+
+    def put(self, city, country, lat, lon):
+        """
+        Store the coordinates for a city
+        """
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO geocodes (city, country, lat, lon) "
+                              "VALUES (?, ?, ?, ?)",
+                              (city.lower(), str(country).upper(), lat, lon))
+            self.conn.commit()
+
+    def report(self):
+        """
+        Summarise hit/miss statistics
+        """
+        return f"Geocode cache: hits {self.hits} misses {self.misses}"
+
+    def close(self):
+        """
+        Close the cache
+        """
+        self.conn.close()
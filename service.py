@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Run group searches as a long lived service
+Authentication, the datastore and caches stay warm between runs, results are
+refreshed on a schedule, and the filtered groups are served as JSON over a
+local HTTP endpoint
+"""
+import json
+import time
+import argparse
+import logging
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import query_meetup
+import group_search
+
+# Hours between scheduled refreshes
+REFRESH_INTERVAL = 6
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8080
+# Seconds before retrying a failed token refresh, doubling up to the maximum
+TOKEN_RETRY = 30
+TOKEN_RETRY_MAX = 3600
+
+def config_handler():
+    '''
+    Manage service configuration parsing
+    '''
+    parser = argparse.ArgumentParser(description='Serve Meetup.com group search results')
+    parser.add_argument('--config',
+                        action="store",
+                        help='configuration file',
+                        required=True)
+    parser.add_argument('--port',
+                        action="store",
+                        type=int,
+                        help='port to serve results on')
+    parser.add_argument('--interval',
+                        action="store",
+                        type=float,
+                        help='hours between refreshes')
+    parser.add_argument('--async',
+                        action="store_true",
+                        dest="async_mode",
+                        help='fetch group data concurrently')
+    args = parser.parse_args()
+    cfg = group_search.load_config(args.config)
+    group_search.set_datastore_paths(cfg, args.config)
+    if args.port is not None:
+        cfg['groups']['service_port'] = args.port
+    if args.interval is not None:
+        cfg['groups']['refresh_interval'] = args.interval
+    # Stored data is reused between refreshes, so always run incrementally
+    cfg['groups']['incremental'] = True
+    return args, cfg
+
+class GroupService:
+    '''
+    Hold the warm connection and datastore, and the latest results
+    '''
+    def __init__(self, meetup_conn, cfg):
+        self.meetup_conn = meetup_conn
+        self.cfg = cfg
+        self.interval = cfg['groups'].get('refresh_interval', REFRESH_INTERVAL) * 3600
+        self.columns = group_search.base_columns()
+        self.filters = group_search.filter_handler(cfg)
+        group_search.add_filter_columns(self.columns, self.filters)
+        self.groups = []
+        self.status = {'refreshes': 0,
+                       'last_refresh': None,
+                       'last_seconds': None,
+                       'last_error': None,
+                       'refreshing': False}
+        self.token_retry = None
+        self.token_retry_at = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+
+    def refresh(self, store):
+        '''
+        Search, check and filter groups, replacing the served results
+        '''
+        started = time.time()
+        with self.lock:
+            self.status['refreshing'] = True
+        group_search.start_run(store, False)
+        res = group_search.search_for_groups(self.meetup_conn, self.cfg, store)
+        groups = group_search.check_groups(self.meetup_conn, self.cfg, res, store)
+        groups = query_meetup.de_dupe(groups,
+                                      self.cfg['groups'].get('dedupe_key',
+                                                             query_meetup.DEDUPE_KEY))
+        pipeline = group_search.build_pipeline(self.cfg, self.filters)
+        groups = pipeline.run(self.meetup_conn,
+                              groups,
+                              store,
+                              group_search.refresh_age(self.cfg))
+        print(pipeline.report())
+        group_search.create_outputs(self.cfg,
+                                    self.columns,
+                                    groups,
+                                    [group_search.ChangeReporter(store, self.cfg, self.columns)])
+        store.clear_checkpoints()
+        with self.lock:
+            self.groups = groups
+            self.status['refreshes'] += 1
+            self.status['last_refresh'] = time.time()
+            self.status['last_seconds'] = round(time.time() - started, 3)
+            self.status['last_error'] = None
+            self.status['refreshing'] = False
+        print(f"Refreshed {len(groups)} groups in {time.time() - started:.1f}s")
+
+    def next_wait(self, next_refresh):
+        '''
+        Seconds to sleep until the next refresh or token refresh is due
+        '''
+        now = time.time()
+        wait = next_refresh - now
+        token_due = self.meetup_conn.token_due()
+        if token_due is not None:
+            # A failed refresh isn't tried again until its backoff is over
+            if self.token_retry_at is not None:
+                token_due = max(token_due, self.token_retry_at - now)
+            wait = min(wait, token_due)
+        return max(wait, 0)
+
+    def check_token(self):
+        '''
+        Refresh the token if it is due, backing off after failures
+        '''
+        if self.token_retry_at is not None and time.time() < self.token_retry_at:
+            return
+        try:
+            self.meetup_conn.ensure_token()
+        except (Exception, SystemExit) as error: # pylint: disable=broad-except
+            self.token_retry = min(2 * self.token_retry if self.token_retry else TOKEN_RETRY,
+                                   TOKEN_RETRY_MAX)
+            self.token_retry_at = time.time() + self.token_retry
+            logging.error("Token refresh failed, retrying in %ds: %s", self.token_retry, error)
+            with self.lock:
+                self.status['last_error'] = f"Token refresh failed: {error}"
+            return
+        self.token_retry = None
+        self.token_retry_at = None
+
+    def run(self):
+        '''
+        Refresh on a schedule until stopped
+        The datastore is opened here, as SQLite connections belong to the
+        thread that opened them
+        '''
+        store = None
+        next_refresh = time.time()
+        try:
+            while not self.stopping.is_set():
+                try:
+                    if store is None:
+                        store = group_search.open_datastore(self.cfg)
+                    self.check_token()
+                    if self.wake.is_set() or time.time() >= next_refresh:
+                        self.wake.clear()
+                        self.refresh(store)
+                        next_refresh = time.time() + self.interval
+                except (Exception, SystemExit) as error: # pylint: disable=broad-except
+                    logging.exception("Refresh failed")
+                    with self.lock:
+                        self.status['last_error'] = str(error)
+                        self.status['refreshing'] = False
+                    next_refresh = time.time() + self.interval
+                self.wake.wait(self.next_wait(next_refresh))
+        finally:
+            if store is not None:
+                store.close()
+
+    def stop(self):
+        '''
+        Stop the scheduler after any refresh in progress
+        '''
+        self.stopping.set()
+        self.wake.set()
+
+    def get_groups(self, params):
+        '''
+        Served groups, narrowed by min_members, country and name parameters
+        '''
+        with self.lock:
+            groups = self.groups
+        if 'min_members' in params:
+            min_members = int(params['min_members'][0])
+            groups = [group for group in groups if (group.get('members') or 0) >= min_members]
+        if 'country' in params:
+            country = params['country'][0].lower()
+            groups = [group for group in groups if (group.get('country') or '').lower() == country]
+        if 'name' in params:
+            name = params['name'][0].lower()
+            groups = [group for group in groups if name in (group.get('name') or '').lower()]
+        return [group.to_dict() for group in groups]
+
+    def get_status(self):
+        '''
+        Refresh and API statistics
+        '''
+        with self.lock:
+            status = dict(self.status, groups=len(self.groups))
+        status['token_expires'] = self.meetup_conn.token_expires
+        status['rate_limiter'] = dict(self.meetup_conn.rate_limiter.stats)
+        status['connections'] = self.meetup_conn.connection_stats()
+        with self.meetup_conn.stats_lock:
+            status['api'] = {kind: dict(stats)
+                             for kind, stats in self.meetup_conn.api_stats.items()}
+        if self.meetup_conn.cache:
+            status['cache'] = dict(self.meetup_conn.cache.stats)
+        return status
+
+def make_handler(service):
+    '''
+    Build a request handler class serving results from the service
+    '''
+
+    class Handler(BaseHTTPRequestHandler):
+        '''
+        Serve /groups and /status, and trigger refreshes with POST /refresh
+        '''
+        def do_GET(self): # pylint: disable=invalid-name
+            '''
+            Answer a query for results or status
+            '''
+            url = urlparse(self.path)
+            if url.path == '/groups':
+                try:
+                    self.reply(200, service.get_groups(parse_qs(url.query)))
+                except ValueError as error:
+                    self.reply(400, {'error': str(error)})
+            elif url.path == '/status':
+                self.reply(200, service.get_status())
+            else:
+                self.reply(404, {'error': 'Not found'})
+
+        def do_POST(self): # pylint: disable=invalid-name
+            '''
+            Ask for a refresh as soon as the scheduler is free
+            '''
+            if urlparse(self.path).path == '/refresh':
+                service.wake.set()
+                self.reply(202, {'refresh': 'requested'})
+            else:
+                self.reply(404, {'error': 'Not found'})
+
+        def reply(self, status, payload):
+            '''
+            Send a JSON response
+            '''
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            logging.debug(format, *args)
+
+    return Handler
+
+def main():
+    """
+    Main execution
+    """
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args, cfg = config_handler()
+
+    # Config is parsed once, and the token is fetched once and then refreshed
+    meetup_conn = query_meetup.MSMeetup(args.config, cfg=cfg)
+    if args.async_mode:
+        meetup_conn.async_mode = True
+    service = GroupService(meetup_conn, cfg)
+    # Each refresh should see data no older than the refresh interval
+    meetup_conn.cap_cache_ttls(min(group_search.refresh_age(cfg), service.interval))
+    scheduler = threading.Thread(target=service.run, daemon=True)
+    scheduler.start()
+
+    server = ThreadingHTTPServer((cfg['groups'].get('service_host', SERVICE_HOST),
+                                  cfg['groups'].get('service_port', SERVICE_PORT)),
+                                 make_handler(service))
+    host, port = server.server_address[:2]
+    print(f"Serving groups at http://{host}:{port}/groups")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        server.server_close()
+        service.stop()
+        scheduler.join()
+        meetup_conn.close()
+
+if __name__ == "__main__":
+    main()
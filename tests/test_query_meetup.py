@@ -0,0 +1,122 @@
+"""
+Tests for query_meetup against a local HTTP server
+"""
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+import query_meetup
+
+class FakeServer:
+    """
+    Local server answering each POST with respond(path, headers), which
+    returns a (status, headers, body) tuple
+    """
+    def __init__(self, respond):
+        self.respond = respond
+        self.hits = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """
+            Reply with the server's responses, counting every hit
+            """
+            def do_POST(self): # pylint: disable=invalid-name
+                """
+                Answer a query
+                """
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with server.lock:
+                    server.hits += 1
+                    status, headers, body = server.respond(self.path, self.headers)
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args): # pylint: disable=redefined-builtin
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/gql'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+@pytest.fixture
+def meetup(monkeypatch):
+    """
+    A connection configured from the environment, with no cache
+    """
+    monkeypatch.setenv('MEETUP_CLIENT_ID', 'id')
+    monkeypatch.setenv('MEETUP_CLIENT_SECRET', 'secret')
+    conn = query_meetup.MSMeetup(None)
+    conn.rate_limiter = query_meetup.AdaptiveRateLimiter(100, backoff_factor=0.01)
+    yield conn
+    conn.session.close()
+
+def test_retry_after_reaches_rate_limiter(meetup):
+    """
+    429s with Retry-After are retried by graphql_query, not urllib3, so the
+    limiter sees every one and each HTTP hit follows a limiter acquire
+    """
+    throttled = (429, {'Retry-After': '0'}, {'errors': [{'message': 'Too many requests'}]})
+    responses = [throttled, throttled]
+    acquires = []
+    acquire = meetup.rate_limiter.acquire
+    meetup.rate_limiter.acquire = lambda: acquires.append(1) or acquire()
+    def respond(path, headers): # pylint: disable=unused-argument
+        return responses.pop(0) if responses else (200, {}, {'data': {'ok': True}})
+
+    with FakeServer(respond) as server:
+        meetup.base_api_url = server.url
+        result = meetup.graphql_query('query { ok }', '{}')
+    assert result == {'data': {'ok': True}}
+    assert server.hits == len(acquires) == 3
+    assert meetup.rate_limiter.stats['backoffs'] == 2
+
+def test_token_refreshed_once_when_it_expires_mid_run(meetup):
+    """
+    A token expiring part way through a run is refreshed before the next
+    query, once however many workers notice, and never sent expired
+    """
+    tokens = {'sent': [], 'refreshes': 0}
+
+    def respond(path, headers):
+        if path.startswith('/access'):
+            tokens['refreshes'] += 1
+            return 200, {}, {'access_token': 'new', 'refresh_token': 'r2', 'expires_in': 3600}
+        tokens['sent'].append(headers['Authorization'])
+        if headers['Authorization'] != 'bearer ' + tokens.get('valid', 'old'):
+            return 401, {}, {'errors': [{'message': 'Invalid token'}]}
+        return 200, {}, {'data': {'ok': True}}
+
+    with FakeServer(respond) as server:
+        meetup.base_api_url = server.url
+        meetup.access_url = server.url.replace('/gql', '/access')
+        meetup.oauth_headers = meetup.set_token({'access_token': 'old',
+                                                 'refresh_token': 'r1',
+                                                 'expires_in': 3600})
+        assert meetup.graphql_query('query { ok }', '{}') == {'data': {'ok': True}}
+        # The old token expires while the run is still going
+        meetup.token_expires = time.time()
+        tokens['valid'] = 'new'
+        meetup.max_concurrency = 8
+        results = meetup.fetch_concurrent(lambda _: meetup.graphql_query('query { ok }', '{}'),
+                                          range(16))
+    assert results == [{'data': {'ok': True}}] * 16
+    assert tokens['refreshes'] == 1
+    assert tokens['sent'] == ['bearer old'] + ['bearer new'] * 16
+    assert meetup.oauth_refresh_token == 'r2'